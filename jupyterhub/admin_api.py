@@ -0,0 +1,49 @@
+"""
+Admin-only hub API endpoints for managing the caches kept by the spawner hooks.
+
+Registered in jupyterhub_config.py through `c.JupyterHub.extra_handlers`, so they are served
+below /hub/api/tacc/.
+"""
+
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.utils import admin_only
+
+from jupyterhub.common import tenant_configs_cache, user_configs_cache
+from jupyterhub.spawner_hooks import tas_identity_cache
+
+
+class UserConfigCacheAPIHandler(APIHandler):
+    """DELETE /hub/api/tacc/caches/user-configs[/<username>]
+
+    Forget the cached user config records of one user, or of everybody, so the next options form
+    or spawn reads them from Agave again. Without a username the tenant and group records are
+    reloaded as well.
+    """
+
+    @admin_only
+    async def delete(self, username=None):
+        user_configs_cache.invalidate(username)
+        if username is None:
+            await tenant_configs_cache.refresh()
+        self.log.info("Invalidated cached user configs for {}".format(username or 'all users'))
+        self.set_status(204)
+
+
+class TasIdentityCacheAPIHandler(APIHandler):
+    """DELETE /hub/api/tacc/caches/tas[/<username>]
+
+    Purge cached TAS identities (uid, gid, homedir), including remembered unknown users, so the next
+    spawn asks TAS again.
+    """
+
+    @admin_only
+    def delete(self, username=None):
+        tas_identity_cache.purge(username)
+        self.log.info("Purged cached TAS identities for {}".format(username or 'all users'))
+        self.set_status(204)
+
+
+default_handlers = [
+    (r'/api/tacc/caches/user-configs(?:/([^/]+))?', UserConfigCacheAPIHandler),
+    (r'/api/tacc/caches/tas(?:/([^/]+))?', TasIdentityCacheAPIHandler),
+]
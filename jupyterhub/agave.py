@@ -2,28 +2,49 @@
 Custom Authenticator to use Agave OAuth with JupyterHub
 """
 
+import hashlib
 import json
 import os
-import re
 import time
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 
 from jupyterhub.auth import LocalAuthenticator
 from kubernetes import client
+from kubernetes.client.rest import ApiException
 from tornado import gen, web
 from tornado.auth import OAuth2Mixin
 from tornado.httpclient import HTTPRequest, AsyncHTTPClient
 from tornado.httputil import url_concat
 from traitlets import Set
 
-from jupyterhub.common import TENANT, INSTANCE, get_tenant_configs, safe_string
+from jupyterhub.common import TENANT, INSTANCE, get_tenant_configs, get_token_configmap_name, kube_client_manager, \
+    token_refresher, TOKEN_DELIVERY_MODE
+from jupyterhub.token_store import get_token_store
 from .oauth2 import OAuthLoginHandler, OAuthenticator
 
 CONFIGS = get_tenant_configs()
 
+# content hash of the last write to each token ConfigMap, by ConfigMap name.
+_configmap_hashes = {}
+# earlier versions kept each token file in its own ConfigMap, named after the token ConfigMap plus
+# one of these suffixes. they are deleted when a user's token ConfigMap is first created.
+LEGACY_TOKEN_CONFIGMAP_SUFFIXES = ('agpy', 'current')
+
+# whether tokens are also written to the token store (see token_store.py). the spawner hooks read
+# them from auth_state and only fall back to the token store when auth_state is not enabled.
+TOKEN_FILES_ENABLED = os.environ.get('TOKEN_FILES_ENABLED', 'True').lower() in ('true', 'yes', '1')
+# token files and ConfigMaps are written in the background from these bounded pools, never on the
+# IOLoop. they are separate so a backlog of ConfigMap writes cannot hold up the token files.
+TOKEN_FILE_WORKERS = int(os.environ.get('TOKEN_FILE_WORKERS', 4))
+CONFIGMAP_WORKERS = int(os.environ.get('CONFIGMAP_WORKERS', 4))
+token_file_executor = ThreadPoolExecutor(TOKEN_FILE_WORKERS)
+configmap_executor = ThreadPoolExecutor(CONFIGMAP_WORKERS)
+
+
 class AgaveMixin(OAuth2Mixin):
-    _OAUTH_AUTHORIZE_URL = "{}/oauth2/authorize".format(CONFIGS.get('agave_base_url').rstrip('/'))
-    _OAUTH_ACCESS_TOKEN_URL = "{}/token".format(CONFIGS.get('agave_base_url').rstrip('/'))
+    _OAUTH_AUTHORIZE_URL = "{}/oauth2/authorize".format(CONFIGS.agave_base_url)
+    _OAUTH_ACCESS_TOKEN_URL = "{}/token".format(CONFIGS.agave_base_url)
 
 
 class AgaveLoginHandler(OAuthLoginHandler, AgaveMixin):
@@ -31,7 +52,7 @@ class AgaveLoginHandler(OAuthLoginHandler, AgaveMixin):
 
 
 class AgaveOAuthenticator(OAuthenticator):
-    login_service = CONFIGS.get('agave_login_button_text')
+    login_service = CONFIGS.agave_login_button_text
     login_handler = AgaveLoginHandler
 
     team_whitelist = Set(
@@ -39,6 +60,10 @@ class AgaveOAuthenticator(OAuthenticator):
         help="Automatically whitelist members of selected teams",
     )
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        token_refresher.start(self.refresh_user_token)
+
     @gen.coroutine
     def authenticate(self, handler, data):
         self.log.info('data', data)
@@ -51,20 +76,20 @@ class AgaveOAuthenticator(OAuthenticator):
         params = dict(
             grant_type="authorization_code",
             code=code,
-            redirect_uri=CONFIGS.get('oauth_callback_url'),
-            client_id=CONFIGS.get('agave_client_id'),
-            client_secret=CONFIGS.get('agave_client_secret')
+            redirect_uri=CONFIGS.oauth_callback_url,
+            client_id=CONFIGS.agave_client_id,
+            client_secret=CONFIGS.agave_client_secret
         )
 
         url = url_concat(
-            "{}/oauth2/token".format(CONFIGS.get('agave_base_url').rstrip('/')), params)
+            "{}/oauth2/token".format(CONFIGS.agave_base_url), params)
         self.log.info(url)
         self.log.info(params)
         bb_header = {"Content-Type":
                      "application/x-www-form-urlencoded;charset=utf-8"}
         req = HTTPRequest(url,
                           method="POST",
-                          validate_cert=eval(CONFIGS.get('oauth_validate_cert')),
+                          validate_cert=CONFIGS.oauth_validate_cert,
                           body=urllib.parse.urlencode(params).encode('utf-8'),
                           headers=bb_header
                           )
@@ -86,8 +111,8 @@ class AgaveOAuthenticator(OAuthenticator):
                    "User-Agent": "JupyterHub",
                    "Authorization": "Bearer {}".format(access_token)
                    }
-        req = HTTPRequest("{}/profiles/v2/me".format(CONFIGS.get('agave_base_url').rstrip('/')),
-                          validate_cert=eval(CONFIGS.get('oauth_validate_cert')),
+        req = HTTPRequest("{}/profiles/v2/me".format(CONFIGS.agave_base_url),
+                          validate_cert=CONFIGS.oauth_validate_cert,
                           method="GET",
                           headers=headers
                           )
@@ -96,102 +121,193 @@ class AgaveOAuthenticator(OAuthenticator):
         self.log.info('resp_json after /profiles/v2/me:', str(resp_json))
         username = resp_json["result"]["username"]
 
-        self.ensure_token_dir(username)
         self.save_token(access_token, refresh_token, username, created_at, expires_in, expires_at)
-        return username
+        token_refresher.track(username, access_token, refresh_token, created_at + expires_in)
+        return {
+            'name': username,
+            'auth_state': self.get_auth_state(access_token, refresh_token, created_at + expires_in),
+        }
+
+    def get_auth_state(self, access_token, refresh_token, expires_at):
+        return {
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_at': expires_at,
+            'api_server': CONFIGS.agave_base_url,
+        }
+
+    async def refresh_user(self, user, handler=None):
+        """Keep the token refresh scheduler and the user's auth_state in step.
+
+        JupyterHub calls this for requests made as the user, which includes the running notebook
+        server checking its token with the hub. With entrypoint token delivery, whose pods pick up
+        new tokens, a user with a running server is marked active, so servers that outlived a hub
+        restart have their tokens refreshed again, taking the tokens from auth_state when the
+        scheduler does not know them yet. Tokens the scheduler renewed are copied into auth_state.
+        """
+        auth_state = await user.get_auth_state() if self.enable_auth_state else None
+        latest = token_refresher.latest(user.name)
+        if not latest and auth_state and auth_state.get('access_token'):
+            token_refresher.track(user.name, auth_state['access_token'], auth_state['refresh_token'],
+                                  auth_state.get('expires_at', 0))
+            latest = token_refresher.latest(user.name)
+        if TOKEN_DELIVERY_MODE == 'entrypoint' and any(spawner.active for spawner in user.spawners.values()):
+            token_refresher.set_active(user.name, True)
+        if not latest or not self.enable_auth_state:
+            return True
+        if auth_state and auth_state.get('expires_at', 0) >= latest['expires_at']:
+            return True
+        return {
+            'name': user.name,
+            'auth_state': self.get_auth_state(latest['access_token'], latest['refresh_token'], latest['expires_at']),
+        }
+
+    @gen.coroutine
+    def refresh_user_token(self, username, refresh_token):
+        """Exchange `refresh_token` for new tokens and store them like a login would.
+
+        Used by the token refresh scheduler. Returns (access_token, refresh_token, expires_at).
+        """
+        params = dict(
+            grant_type="refresh_token",
+            refresh_token=refresh_token,
+            client_id=CONFIGS.agave_client_id,
+            client_secret=CONFIGS.agave_client_secret
+        )
+        bb_header = {"Content-Type":
+                     "application/x-www-form-urlencoded;charset=utf-8"}
+        req = HTTPRequest("{}/oauth2/token".format(CONFIGS.agave_base_url),
+                          method="POST",
+                          validate_cert=CONFIGS.oauth_validate_cert,
+                          body=urllib.parse.urlencode(params).encode('utf-8'),
+                          headers=bb_header
+                          )
+        resp = yield AsyncHTTPClient().fetch(req)
+        resp_json = json.loads(resp.body.decode('utf8', 'replace'))
 
-    def ensure_token_dir(self, username):
+        access_token = resp_json['access_token']
+        refresh_token = resp_json['refresh_token']
         try:
-            os.makedirs(self.get_user_token_dir(username))
-        except OSError as e:
-            self.log.info("Got error trying to make token dir: "
-                          "{} exception: {}".format(self.get_user_token_dir(username), e))
-
-    def get_user_token_dir(self, username):
-        return os.path.join(
-            '/agave/jupyter/tokens',
-            INSTANCE,
-            TENANT,
-            username)
+            expires_in = int(resp_json['expires_in'])
+        except (KeyError, ValueError):
+            expires_in = 3600
+        created_at = time.time()
+        self.save_token(access_token, refresh_token, username, created_at, expires_in,
+                        time.ctime(created_at + expires_in))
+        self.log.info("Refreshed the stored token of {}".format(username))
+        return access_token, refresh_token, created_at + expires_in
 
     def save_token(self, access_token, refresh_token, username, created_at, expires_in, expires_at):
-        tenant_id = CONFIGS.get('agave_tenant_id')
-        # agavepy file
-        d = [{'token': access_token,
-              'refresh_token': refresh_token,
-              'tenant_id': tenant_id,
-              'api_key': CONFIGS.get('agave_client_id'),
-              'api_secret': CONFIGS.get('agave_client_secret'),
-              'api_server': '{}'.format(CONFIGS.get('agave_base_url').rstrip('/')),
-              'verify': eval(CONFIGS.get('oauth_validate_cert')),
-              }]
-        with open(os.path.join(self.get_user_token_dir(username), '.agpy'), 'w') as f:
-            json.dump(d, f)
-        self.log.info("Saved agavepy cache file to {}".format(os.path.join(self.get_user_token_dir(username), '.agpy')))
-        self.log.info("agavepy cache file data: {}".format(d))
-        self.create_configmap(username, '.agpy', json.dumps(d))
+        """Write the token files of `username` to the token store (when TOKEN_FILES_ENABLED) and to
+        the token ConfigMap the notebook pod mounts, both in the background.
+
+        Logins and refreshes do not wait for either: the hub itself keeps the tokens in auth_state.
+        """
+        files = self.get_token_files(access_token, refresh_token, username, created_at, expires_in, expires_at)
+        if TOKEN_FILES_ENABLED:
+            future = token_file_executor.submit(self.write_token_files, username, files)
+            future.add_done_callback(self._log_token_files_error)
+        configmap_data = {name: json.dumps(d) for name, d in files.items()}
+        future = configmap_executor.submit(self.apply_token_configmap, username, configmap_data)
+        future.add_done_callback(self._log_configmap_error)
 
+    def get_token_files(self, access_token, refresh_token, username, created_at, expires_in, expires_at):
+        tenant_id = CONFIGS.agave_tenant_id
+        # agavepy file
+        agpy = [{'token': access_token,
+                 'refresh_token': refresh_token,
+                 'tenant_id': tenant_id,
+                 'api_key': CONFIGS.agave_client_id,
+                 'api_secret': CONFIGS.agave_client_secret,
+                 'api_server': CONFIGS.agave_base_url,
+                 'verify': CONFIGS.oauth_validate_cert,
+                 }]
         # cli file
-        d = {'tenantid': tenant_id,
-             'baseurl': '{}'.format(CONFIGS.get('agave_base_url').rstrip('/')),
-             'devurl': '',
-             'apikey': CONFIGS.get('agave_client_id'),
-             'username': username,
-             'access_token': access_token,
-             'refresh_token': refresh_token,
-             'created_at': str(int(created_at)),
-             'apisecret': CONFIGS.get('agave_client_secret'),
-             'expires_in': str(expires_in),
-             'expires_at': str(expires_at)
-             }
-        with open(os.path.join(self.get_user_token_dir(username), 'current'), 'w') as f:
-            json.dump(d, f)
-        self.log.info("Saved CLI cache file to {}".format(os.path.join(self.get_user_token_dir(username), 'current')))
-        self.log.info("CLI cache file data: {}".format(d))
-        self.create_configmap(username, 'current', json.dumps(d))
-
-    def create_configmap(self, username, name, d):
-        with open('/run/secrets/kubernetes.io/serviceaccount/token') as f:
-            token = f.read()
-        with open('/run/secrets/kubernetes.io/serviceaccount/namespace') as f:
-            namespace = f.read()
-
-        configuration = client.Configuration()
-        configuration.api_key['authorization'] = 'Bearer {}'.format(token)
-        configuration.host = 'https://kubernetes.default'
-        configuration.ssl_ca_cert = '/run/secrets/kubernetes.io/serviceaccount/ca.crt'
-
-        api_instance = client.CoreV1Api(client.ApiClient(configuration))
-
-        safe_username = safe_string(username).lower()
-        safe_tenant = safe_string(TENANT).lower()
-        safe_instance = safe_string(INSTANCE).lower()
-        configmap_name_prefix = '{}-{}-{}-jhub'.format(safe_username, safe_tenant, safe_instance)
-        configmap_name = '{}-{}'.format(configmap_name_prefix, re.sub('[^A-Za-z0-9]+', '', name))  # remove the . from .agpy to accomodate k8 naming rules
+        current = {'tenantid': tenant_id,
+                   'baseurl': CONFIGS.agave_base_url,
+                   'devurl': '',
+                   'apikey': CONFIGS.agave_client_id,
+                   'username': username,
+                   'access_token': access_token,
+                   'refresh_token': refresh_token,
+                   'created_at': str(int(created_at)),
+                   'apisecret': CONFIGS.agave_client_secret,
+                   'expires_in': str(expires_in),
+                   'expires_at': str(expires_at)
+                   }
+        return {'.agpy': agpy, 'current': current}
+
+    def write_token_files(self, username, files):
+        get_token_store().put(username, files)
+        self.log.info("Saved {} token files of {}".format(', '.join(files), username))
+
+    def _log_token_files_error(self, future):
+        if future.exception():
+            self.log.error("Writing the token files failed: {}".format(future.exception()))
+
+    def _log_configmap_error(self, future):
+        if future.exception():
+            self.log.error("Writing the token configmap failed: {}".format(future.exception()))
+
+    def apply_token_configmap(self, username, data):
+        """Upsert the ConfigMap holding all token files of `username`, one key per file.
+
+        The ConfigMap is patched in place in a single call and only created when it does not exist
+        yet, at which point the per-file ConfigMaps of earlier versions are deleted. Running pods
+        therefore never see their mount source disappear. A write whose content hash matches the last
+        one written by this hub is skipped. Failed writes are logged and re-raised.
+        """
+        namespace = kube_client_manager.namespace
+        api_instance = kube_client_manager.core_v1()
+
+        configmap_name = get_token_configmap_name(username)
+        content_hash = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+        if _configmap_hashes.get(configmap_name) == content_hash:
+            self.log.info('{} configmap unchanged, skipping write'.format(configmap_name))
+            return
 
         body = client.V1ConfigMap(
-            data={name: str(d)},
+            data=data,
             metadata={
                 'name': configmap_name,
-                'labels': {'app': configmap_name_prefix, 'tenant': TENANT, 'instance': INSTANCE, 'username': username}
+                'labels': {'app': configmap_name, 'tenant': TENANT, 'instance': INSTANCE, 'username': username},
+                'annotations': {'jupyterhub.tacc.utexas.edu/content-hash': content_hash},
             }
         )
 
         self.log.info('{}:{}'.format('configmap body', body))
 
-        try: # delete any current configmaps to ensure no stale tokens
-            api_response = api_instance.delete_namespaced_config_map(configmap_name, namespace)
-            self.log.info('{} configmap deleted'.format(configmap_name))
-            print(str(api_response))
-        except Exception as e:
-            print("Exception when calling CoreV1Api->delete_namespaced_config_map: %s\n" % e)
-
         try:
-            api_response = api_instance.create_namespaced_config_map(namespace, body)
-            self.log.info('{} configmap created'.format(name))
-            print(str(api_response))
+            api_instance.patch_namespaced_config_map(configmap_name, namespace, body)
+            self.log.info('{} configmap patched'.format(configmap_name))
+        except ApiException as e:
+            if e.status != 404:
+                self.log.error("Exception when calling CoreV1Api->patch_namespaced_config_map: {}".format(e))
+                raise
+            try:
+                api_instance.create_namespaced_config_map(namespace, body)
+                self.log.info('{} configmap created'.format(configmap_name))
+            except Exception as e:
+                self.log.error("Exception when calling CoreV1Api->create_namespaced_config_map: {}".format(e))
+                raise
+            self.delete_legacy_token_configmaps(configmap_name)
         except Exception as e:
-            print("Exception when calling CoreV1Api->create_namespaced_config_map: %s\n" % e)
+            self.log.error("Exception when calling CoreV1Api->patch_namespaced_config_map: {}".format(e))
+            raise
+        _configmap_hashes[configmap_name] = content_hash
+
+    def delete_legacy_token_configmaps(self, configmap_name):
+        """Delete the per-file token ConfigMaps an earlier version kept next to `configmap_name`."""
+        namespace = kube_client_manager.namespace
+        api_instance = kube_client_manager.core_v1()
+        for suffix in LEGACY_TOKEN_CONFIGMAP_SUFFIXES:
+            legacy_name = '{}-{}'.format(configmap_name, suffix)
+            try:
+                api_instance.delete_namespaced_config_map(legacy_name, namespace)
+                self.log.info('{} configmap deleted'.format(legacy_name))
+            except ApiException as e:
+                if e.status != 404:
+                    self.log.warning("Exception when calling CoreV1Api->delete_namespaced_config_map: {}".format(e))
 
 
 class LocalAgaveOAuthenticator(LocalAuthenticator, AgaveOAuthenticator):
@@ -1,13 +1,55 @@
+import asyncio
+import datetime
+import hashlib
+import heapq
+import json
 import os
 import string
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 from agavepy.agave import Agave
+from kubernetes import client
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httputil import url_concat
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Event, Semaphore
+from tornado.log import app_log
+from tornado.util import TimeoutError
+
+from jupyterhub.config_schema import ConfigError, compile_tenant_config, compile_user_config
 
 INSTANCE = os.environ.get('INSTANCE')
 TENANT = os.environ.get('TENANT')
 service_token = os.environ.get('AGAVE_SERVICE_TOKEN')
 base_url = os.environ.get('AGAVE_BASE_URL', "https://api.tacc.utexas.edu")
+# seconds a cached tenant config is considered fresh; it is refreshed in the background after that.
+TENANT_CONFIGS_TTL = int(os.environ.get('TENANT_CONFIGS_TTL', 300))
+# seconds a user's config records are served from memory, and how many users are kept.
+USER_CONFIGS_TTL = int(os.environ.get('USER_CONFIGS_TTL', 120))
+USER_CONFIGS_CACHE_SIZE = int(os.environ.get('USER_CONFIGS_CACHE_SIZE', 5000))
+# most records returned by the tenant query, i.e. the tenant record plus all of its group records.
+TENANT_METADATA_LIMIT = int(os.environ.get('TENANT_METADATA_LIMIT', 1000))
+# limits for the async Agave client: concurrent connections and per-request timeouts in seconds.
+AGAVE_MAX_CLIENTS = int(os.environ.get('AGAVE_MAX_CLIENTS', 20))
+AGAVE_CONNECT_TIMEOUT = float(os.environ.get('AGAVE_CONNECT_TIMEOUT', 5))
+AGAVE_REQUEST_TIMEOUT = float(os.environ.get('AGAVE_REQUEST_TIMEOUT', 20))
+# in-cluster Kubernetes API access through the pod's service account.
+KUBERNETES_HOST = os.environ.get('KUBERNETES_HOST', 'https://kubernetes.default')
+SERVICE_ACCOUNT_DIR = os.environ.get('SERVICE_ACCOUNT_DIR', '/run/secrets/kubernetes.io/serviceaccount')
+# stored tokens are refreshed this many seconds before they expire, at most BATCH_SIZE per round
+# with at most CONCURRENCY refresh calls in flight; failed refreshes are retried after RETRY seconds.
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 60 * 5))
+TOKEN_REFRESH_BATCH_SIZE = int(os.environ.get('TOKEN_REFRESH_BATCH_SIZE', 50))
+TOKEN_REFRESH_CONCURRENCY = int(os.environ.get('TOKEN_REFRESH_CONCURRENCY', 5))
+TOKEN_REFRESH_RETRY = int(os.environ.get('TOKEN_REFRESH_RETRY', 60))
+# how the token files get into the notebook pod: 'init-container' copies them out of the ConfigMap
+# with a busybox init container, 'entrypoint' has the notebook command copy them and keep copying
+# updates (see spawner_hooks.add_token_mounts). Only 'entrypoint' pods see refreshed tokens, so the
+# tokens of running servers are only refreshed in that mode.
+TOKEN_DELIVERY_MODE = os.environ.get('TOKEN_DELIVERY_MODE', 'init-container')
 
 if not service_token:
     raise Exception("Missing SERVICE_TOKEN configuration.")
@@ -17,17 +59,400 @@ def get_config_metadata_name():
     return 'config.{}.{}.jhub'.format(TENANT, INSTANCE)
 
 
-def get_tenant_configs():
+_http_client = None
+
+
+def get_http_client():
+    """The AsyncHTTPClient shared by all remote calls made from the hub process.
+
+    It is a dedicated instance, so its connection limit does not compete with the proxy and hub
+    API traffic. The curl implementation is used when pycurl is available because it keeps
+    connections to Agave alive between requests.
+    """
+    global _http_client
+    if _http_client is None:
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            _http_client = CurlAsyncHTTPClient(force_instance=True, max_clients=AGAVE_MAX_CLIENTS)
+        except ImportError:
+            _http_client = AsyncHTTPClient(force_instance=True, max_clients=AGAVE_MAX_CLIENTS)
+    return _http_client
+
+
+class AgaveMetadataClient(object):
+    """Non-blocking client for the Agave metadata service, for use on the hub's IOLoop."""
+
+    def __init__(self, api_server, token):
+        self.api_server = api_server.rstrip('/')
+        self.token = token
+
+    async def list_metadata(self, q, limit=None):
+        params = {'q': json.dumps(q)}
+        if limit:
+            params['limit'] = limit
+        req = HTTPRequest(url_concat('{}/meta/v2/data'.format(self.api_server), params),
+                          headers={'Accept': 'application/json',
+                                   'Authorization': 'Bearer {}'.format(self.token)},
+                          connect_timeout=AGAVE_CONNECT_TIMEOUT,
+                          request_timeout=AGAVE_REQUEST_TIMEOUT,
+                          )
+        rsp = await get_http_client().fetch(req)
+        return json.loads(rsp.body.decode('utf8', 'replace'))['result']
+
+
+def get_service_client():
+    return AgaveMetadataClient(base_url, service_token)
+
+
+def get_tenant_query():
+    """A single query for the tenant config record and all group config records of the tenant."""
+    return {'$or': [{'name': get_config_metadata_name()},
+                    {'value.config_type': 'group', 'value.tenant': TENANT, 'value.instance': INSTANCE}]}
+
+
+def fetch_tenant_configs():
+    """Blocking fetch of the tenant and group records, only used for the first load while the hub starts up."""
     ag = Agave(api_server=base_url, token=service_token)
-    q = {'name': get_config_metadata_name()}
+    q = get_tenant_query()
     print('tenant query: {}'.format(q))
-    return ag.meta.listMetadata(q=str(q))[0]['value']
+    return ag.meta.listMetadata(q=json.dumps(q), limit=TENANT_METADATA_LIMIT)
+
+
+async def fetch_tenant_configs_async():
+    q = get_tenant_query()
+    app_log.debug('tenant query: {}'.format(q))
+    return await get_service_client().list_metadata(q, limit=TENANT_METADATA_LIMIT)
+
+
+class TenantConfigCache(object):
+    """Process-wide cache of the tenant config metadata record, compiled into a TenantConfig, and of
+    the tenant's group config records.
+
+    The tenant record and every group record are fetched together with one metadata query. Groups
+    are indexed by username, so all members of a group share one compiled UserConfig instead of each
+    fetching it with their own records.
+
+    Only the first read waits on Agave. After that the records are refreshed every `ttl` seconds by
+    a periodic callback on the IOLoop, and a read that finds an entry older than `ttl` gets the stale
+    value while a single background refresh runs (stale-while-revalidate).
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._value = None
+        self._user_groups = {}
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refresher = None
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._store(fetch_tenant_configs())
+            self.start_refresher()
+        elif self.is_stale():
+            self.refresh_in_background()
+        return self._value
+
+    def is_stale(self):
+        return time.time() - self._fetched_at > self.ttl
+
+    def groups_for(self, username):
+        """The group configs `username` is a member of."""
+        return self._user_groups.get(username, ())
+
+    def _store(self, records):
+        name = get_config_metadata_name()
+        tenant = [r for r in records if r.get('name') == name]
+        if not tenant:
+            raise ConfigError("tenant config record {} not found".format(name))
+        user_groups = {}
+        for group in compile_user_configs([r for r in records if r.get('name') != name]):
+            for username in group.users:
+                user_groups.setdefault(username, []).append(group)
+        self._value = compile_tenant_config(tenant[0]['value'])
+        self._user_groups = {username: tuple(items) for username, items in user_groups.items()}
+        self._fetched_at = time.time()
+
+    async def refresh(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+        try:
+            value = await fetch_tenant_configs_async()
+            self._store(value)
+        except Exception as e:
+            app_log.error("Could not refresh tenant configs, still serving the copy from {}. Exception: {}".format(
+                time.ctime(self._fetched_at), e))
+        finally:
+            self._refreshing = False
+
+    def refresh_in_background(self):
+        IOLoop.current().spawn_callback(self.refresh)
+
+    def start_refresher(self):
+        if self._refresher is None and self.ttl > 0:
+            self._refresher = PeriodicCallback(self.refresh, self.ttl * 1000)
+            self._refresher.start()
+
+
+tenant_configs_cache = TenantConfigCache(TENANT_CONFIGS_TTL)
+
+
+def get_tenant_configs():
+    return tenant_configs_cache.get()
+
+
+async def fetch_user_configs(username):
+    # group records come with the tenant config, see TenantConfigCache.
+    q = {'value.user': username, 'value.tenant': TENANT, 'value.instance': INSTANCE,
+         'value.config_type': {'$ne': 'group'}}
+    app_log.debug('user query: {}'.format(q))
+    return await get_service_client().list_metadata(q)
+
+
+def compile_user_configs(records):
+    """Compile metadata records into UserConfigs, leaving out (and logging) records that do not validate."""
+    compiled = []
+    for record in records:
+        try:
+            compiled.append(compile_user_config(record))
+        except ConfigError as e:
+            app_log.error("Ignoring invalid config record {}: {}".format(record.get('name'), e))
+    return tuple(compiled)
+
+
+def get_configs_version(records):
+    """Version string for compiled config records, built from their uuid and lastUpdated fields."""
+    stamps = sorted('{}@{}'.format(r.uuid, r.last_updated) for r in records)
+    return hashlib.sha1(json.dumps(stamps).encode('utf-8')).hexdigest()
+
+
+class UserConfigCache(object):
+    """LRU cache of the compiled user config records (UserConfigs) for each username, bounded by `maxsize` entries.
+
+    An entry is served from memory for `ttl` seconds. After that the records are fetched again and
+    their version (see `get_configs_version`) is compared with the cached one, so anything keyed on
+    the version stays valid until an admin actually edits a record. Entries can also be dropped
+    explicitly with `invalidate`.
+
+    Concurrent misses for the same username share a single metadata query.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    async def get(self, username):
+        entry = self._lookup(username)
+        if entry is None:
+            fetch = self._inflight.get(username)
+            if fetch is None:
+                fetch = self._inflight[username] = asyncio.ensure_future(self._fetch(username))
+            entry = await fetch
+        return entry['records']
+
+    async def _fetch(self, username):
+        try:
+            return self._store(username, await fetch_user_configs(username))
+        finally:
+            self._inflight.pop(username, None)
+
+    def _lookup(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or time.time() - entry['fetched_at'] > self.ttl:
+                return None
+            self._entries.move_to_end(username)
+            return entry
+
+    def _store(self, username, records):
+        records = compile_user_configs(records)
+        version = get_configs_version(records)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry['version'] != version:
+                entry = {'version': version, 'records': records}
+                self._entries[username] = entry
+            entry['fetched_at'] = time.time()
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, username=None):
+        """Drop the cached records for `username`, or for every user when no username is given."""
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+
+user_configs_cache = UserConfigCache(USER_CONFIGS_CACHE_SIZE, USER_CONFIGS_TTL)
+
+
+async def get_user_configs(username):
+    """The user config records of `username` followed by the configs of the groups they belong to."""
+    records = await user_configs_cache.get(username)
+    return records + tenant_configs_cache.groups_for(username)
+
+class KubeClientManager(object):
+    """Process-wide Kubernetes API client authenticated with the pod's service account.
+
+    A single ApiClient, and so a single urllib3 connection pool, is kept for the life of the process.
+    The token file's mtime is checked on every use, and a rotated token is swapped into the existing
+    configuration instead of building a new client.
+    """
+
+    def __init__(self, host, service_account_dir):
+        self.host = host
+        self.service_account_dir = service_account_dir
+        self._lock = threading.Lock()
+        self._api_client = None
+        self._core_v1 = None
+        self._token_mtime = None
+        self._namespace = None
+
+    def _read(self, name):
+        with open(os.path.join(self.service_account_dir, name)) as f:
+            return f.read()
+
+    @property
+    def namespace(self):
+        if self._namespace is None:
+            self._namespace = self._read('namespace')
+        return self._namespace
+
+    def core_v1(self):
+        token_mtime = os.stat(os.path.join(self.service_account_dir, 'token')).st_mtime
+        with self._lock:
+            if self._api_client is None:
+                configuration = client.Configuration()
+                configuration.host = self.host
+                configuration.ssl_ca_cert = os.path.join(self.service_account_dir, 'ca.crt')
+                self._api_client = client.ApiClient(configuration)
+                self._core_v1 = client.CoreV1Api(self._api_client)
+            if token_mtime != self._token_mtime:
+                self._api_client.configuration.api_key['authorization'] = 'Bearer {}'.format(self._read('token'))
+                self._token_mtime = token_mtime
+        return self._core_v1
+
+
+kube_client_manager = KubeClientManager(KUBERNETES_HOST, SERVICE_ACCOUNT_DIR)
+
+
+class TokenRefreshScheduler(object):
+    """Refreshes the stored Agave tokens of users with a running server shortly before they expire.
+
+    Tracked tokens sit in a heap ordered by the time they are due for a refresh, `margin` seconds
+    before expiry, and a single loop on the IOLoop sleeps until the earliest one is due. Due tokens
+    are refreshed in batches of `batch_size` with at most `concurrency` refresh calls at once.
+    Tokens of users without an active server are left alone until their server starts again; the
+    callers only mark users active when their pods pick up new tokens (TOKEN_DELIVERY_MODE).
+
+    `refresh` is a coroutine function set by the authenticator in `start`. It is called as
+    refresh(username, refresh_token), stores the new tokens, and returns
+    (access_token, refresh_token, expires_at) with expires_at in epoch seconds.
+    """
+
+    def __init__(self, margin, batch_size, concurrency, retry):
+        self.margin = margin
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retry = retry
+        self.refresh = None
+        self._heap = []
+        self._tokens = {}
+        self._active = set()
+        self._wakeup = Event()
+
+    def start(self, refresh):
+        if self.refresh is None:
+            IOLoop.current().spawn_callback(self._run)
+        self.refresh = refresh
+
+    def track(self, username, access_token, refresh_token, expires_at):
+        """Remember the latest tokens of `username` and schedule their refresh."""
+        pending = self._tokens.get(username, {}).get('due')
+        self._tokens[username] = {'access_token': access_token, 'refresh_token': refresh_token,
+                                  'expires_at': expires_at, 'due': pending}
+        self._schedule(username, expires_at - self.margin)
+
+    def latest(self, username):
+        """The most recent tokens stored for `username`, or None."""
+        return self._tokens.get(username)
+
+    def set_active(self, username, active):
+        if active:
+            if username in self._active:
+                return
+            self._active.add(username)
+            token = self._tokens.get(username)
+            if token:
+                self._schedule(username, token['expires_at'] - self.margin)
+        else:
+            self._active.discard(username)
+
+    def _schedule(self, username, due):
+        if self._tokens[username].get('due') == due:
+            # already on the heap; a second entry would refresh the same token twice.
+            return
+        self._tokens[username]['due'] = due
+        heapq.heappush(self._heap, (due, username))
+        if self._heap[0][1] == username:
+            self._wakeup.set()
+
+    def _pop_due(self):
+        due_users = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now and len(due_users) < self.batch_size:
+            due, username = heapq.heappop(self._heap)
+            token = self._tokens.get(username)
+            # skip heap entries superseded by a newer login or refresh, and users without a server;
+            # those get a new entry from set_active when their server starts.
+            if token and token.get('due') == due:
+                token['due'] = None
+                if username in self._active:
+                    due_users.append(username)
+        return due_users
+
+    async def _run(self):
+        semaphore = Semaphore(self.concurrency)
+        while True:
+            due_users = self._pop_due()
+            if due_users:
+                app_log.info("Refreshing tokens for {} users".format(len(due_users)))
+                await asyncio.gather(*[self._refresh_one(username, semaphore) for username in due_users])
+                continue
+            self._wakeup.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else 3600
+            try:
+                await self._wakeup.wait(timeout=datetime.timedelta(seconds=max(delay, 0)))
+            except TimeoutError:
+                pass
+
+    async def _refresh_one(self, username, semaphore):
+        token = self._tokens[username]
+        async with semaphore:
+            try:
+                access_token, refresh_token, expires_at = await self.refresh(username, token['refresh_token'])
+            except Exception as e:
+                app_log.error("Could not refresh the token of {}. Exception: {}".format(username, e))
+                if time.time() < token['expires_at']:
+                    self._schedule(username, time.time() + self.retry)
+                return
+        self.track(username, access_token, refresh_token, expires_at)
+
+
+token_refresher = TokenRefreshScheduler(TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_BATCH_SIZE, TOKEN_REFRESH_CONCURRENCY,
+                                        TOKEN_REFRESH_RETRY)
 
-def get_user_configs(username):
-    ag = Agave(api_server=base_url, token=service_token)
-    q = {'value.user': username, 'value.tenant': TENANT, 'value.instance': INSTANCE}
-    print('user query: {}'.format(q))
-    return ag.meta.listMetadata(q=str(q))
 
 def safe_string(to_escape, safe = set(string.ascii_lowercase + string.digits), escape_char='-'):
     """Escape a string so that it only contains characters in a safe set.
@@ -44,6 +469,12 @@ def safe_string(to_escape, safe = set(string.ascii_lowercase + string.digits), e
     return u''.join(chars)
 
 
+def get_token_configmap_name(username):
+    """Name of the ConfigMap holding the `.agpy` and `current` token files of `username`."""
+    return '{}-{}-{}-jhub'.format(safe_string(username).lower(), safe_string(TENANT).lower(),
+                                  safe_string(INSTANCE).lower())
+
+
 if sys.version_info >= (3,):
     _ord = lambda byte: byte
 else:
@@ -0,0 +1,226 @@
+"""
+Compiles the tenant and user config metadata documents into immutable objects.
+
+Agave metadata values are loosely typed JSON: flags are "True"/"False" strings, memory limits are
+strings like "4G" and cpu limits are strings. Each document is validated and converted once when
+it is fetched. After that the authenticator and the spawner hooks only read precomputed fields,
+and no metadata value is ever passed to eval().
+
+The objects are namedtuples, so they have no per-instance __dict__ and cannot be reassigned.
+Nested pod and container config dicts are shared between spawns and must be copied before they
+are changed.
+"""
+
+import hashlib
+import json
+from collections import namedtuple
+
+import humanfriendly
+
+TRUE_STRINGS = ('true', 'yes', '1')
+FALSE_STRINGS = ('false', 'no', '0', '')
+
+
+class ConfigError(ValueError):
+    """A config metadata document is missing a required field or has a value of the wrong type."""
+    pass
+
+
+def parse_bool(value, field):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        if value.strip().lower() in TRUE_STRINGS:
+            return True
+        if value.strip().lower() in FALSE_STRINGS:
+            return False
+    raise ConfigError("{} must be True or False, got {!r}".format(field, value))
+
+
+def parse_size(value, field):
+    """Parse a memory size such as "4G" into bytes. None stays None."""
+    if value is None:
+        return None
+    try:
+        return humanfriendly.parse_size(str(value))
+    except humanfriendly.InvalidSize:
+        raise ConfigError("{} must be a size such as 4G, got {!r}".format(field, value))
+
+
+def parse_float(value, field):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ConfigError("{} must be a number, got {!r}".format(field, value))
+
+
+def parse_int(value, field):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ConfigError("{} must be an integer, got {!r}".format(field, value))
+
+
+def require(doc, field, where):
+    try:
+        return doc[field]
+    except (KeyError, TypeError):
+        raise ConfigError("{} is missing required field {}".format(where, field))
+
+
+class Image(namedtuple('Image', ['name', 'display_name', 'description', 'hpc_available', 'notebook_dir',
+                                 'extra_pod_config', 'extra_container_config', 'document_json'])):
+    """An image a user can select. `document_json` is its document, as sent to the options form."""
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.name, self.display_name
+
+
+class VolumeMount(namedtuple('VolumeMount', ['type', 'server', 'path', 'mount_path', 'read_only'])):
+    """A volume to mount into the notebook. `path` may contain {username}, {tenant_id} and {tas_homedir}."""
+    __slots__ = ()
+
+
+class TenantConfig(namedtuple('TenantConfig', [
+        'version', 'tenant', 'instance', 'agave_base_url', 'agave_tenant_id', 'agave_client_id',
+        'agave_client_secret', 'agave_login_button_text', 'oauth_callback_url', 'oauth_validate_cert',
+        'admin_users', 'services', 'uid', 'gid', 'mem_limit', 'mem_limit_bytes', 'cpu_limit', 'images',
+        'volume_mounts', 'extra_pod_config', 'extra_container_config', 'host_projects_root_dir',
+        'container_projects_root_dir', 'network_storage', 'projects_mount_mode', 'jupyterh_bearer_token'])):
+    """The config.<tenant>.<instance>.jhub record. `version` is a digest of the source document."""
+    __slots__ = ()
+
+
+class UserConfig(namedtuple('UserConfig', [
+        'uuid', 'name', 'last_updated', 'config_type', 'group_name', 'users', 'mem_limit', 'mem_limit_bytes',
+        'cpu_limit', 'images', 'volume_mounts'])):
+    """A user or group config record. `users` holds the usernames the record applies to."""
+    __slots__ = ()
+
+
+class ResourceProfile(namedtuple('ResourceProfile', ['mem_limit', 'mem_limit_bytes', 'cpu_limit', 'num_threads'])):
+    """The effective limits of a user: the largest of the tenant, group and user layers.
+
+    `mem_limit` is the original string of the winning layer. `num_threads` is the value for the
+    *_NUM_THREADS variables: the whole cpus of the limit, and at least one.
+    """
+    __slots__ = ()
+
+
+def compile_image(doc, where):
+    name = require(doc, 'name', where)
+    where = '{} image {}'.format(where, name)
+    hpc_available = parse_bool(doc.get('hpc_available', False), '{} hpc_available'.format(where))
+    return Image(
+        name=name,
+        display_name=doc.get('display_name'),
+        description=doc.get('description'),
+        hpc_available=hpc_available,
+        notebook_dir=doc.get('notebook_dir', ''),
+        extra_pod_config=doc.get('extra_pod_config') or {},
+        extra_container_config=doc.get('extra_container_config') or {},
+        # the form's script tests hpc_available for truthiness, so it gets a real boolean.
+        document_json=json.dumps(dict(doc, hpc_available=hpc_available)),
+    )
+
+
+def compile_volume_mount(doc, where):
+    mount_path = require(doc, 'mountPath', where)
+    where = '{} volume mount {}'.format(where, mount_path)
+    mount_type = require(doc, 'type', where)
+    return VolumeMount(
+        type=mount_type,
+        server=require(doc, 'server', where) if mount_type == 'nfs' else doc.get('server'),
+        path=require(doc, 'path', where),
+        mount_path=mount_path.rstrip('/') or '/',
+        read_only=parse_bool(require(doc, 'readOnly', where), '{} readOnly'.format(where)),
+    )
+
+
+PROJECTS_MOUNT_MODES = ('volume', 'subpath', 'symlinks')
+
+
+def parse_choice(value, choices, field):
+    if value not in choices:
+        raise ConfigError("{} must be one of {}, got {!r}".format(field, ', '.join(choices), value))
+    return value
+
+
+def compile_tenant_config(doc):
+    """Validate a tenant config document (the record's `value`) into a TenantConfig."""
+    where = 'tenant config'
+    return TenantConfig(
+        version=hashlib.sha1(json.dumps(doc, sort_keys=True, default=str).encode('utf-8')).hexdigest(),
+        tenant=doc.get('tenant'),
+        instance=doc.get('instance'),
+        agave_base_url=require(doc, 'agave_base_url', where).rstrip('/'),
+        agave_tenant_id=doc.get('agave_tenant_id'),
+        agave_client_id=require(doc, 'agave_client_id', where),
+        agave_client_secret=require(doc, 'agave_client_secret', where),
+        agave_login_button_text=doc.get('agave_login_button_text'),
+        oauth_callback_url=require(doc, 'oauth_callback_url', where),
+        oauth_validate_cert=parse_bool(doc.get('oauth_validate_cert', True), 'oauth_validate_cert'),
+        admin_users=tuple(doc.get('admin_users') or ()),
+        services=tuple(doc.get('services') or ()),
+        uid=parse_int(doc.get('uid'), 'uid'),
+        gid=parse_int(doc.get('gid'), 'gid'),
+        mem_limit=require(doc, 'mem_limit', where),
+        mem_limit_bytes=parse_size(doc['mem_limit'], 'mem_limit'),
+        cpu_limit=parse_float(require(doc, 'cpu_limit', where), 'cpu_limit'),
+        images=tuple(compile_image(image, where) for image in doc.get('images') or ()),
+        volume_mounts=tuple(compile_volume_mount(mount, where) for mount in doc.get('volume_mounts') or ()),
+        extra_pod_config=doc.get('extra_pod_config') or {},
+        extra_container_config=doc.get('extra_container_config') or {},
+        host_projects_root_dir=doc.get('host_projects_root_dir'),
+        container_projects_root_dir=doc.get('container_projects_root_dir'),
+        network_storage=doc.get('network_storage'),
+        projects_mount_mode=parse_choice(doc.get('projects_mount_mode', 'volume'), PROJECTS_MOUNT_MODES,
+                                         'projects_mount_mode'),
+        jupyterh_bearer_token=doc.get('jupyterh_bearer_token'),
+    )
+
+
+def compile_user_config(record):
+    """Validate a user or group config metadata record (including uuid/lastUpdated) into a UserConfig."""
+    value = require(record, 'value', 'config record')
+    where = 'config record {}'.format(record.get('name'))
+    users = value.get('user')
+    return UserConfig(
+        uuid=record.get('uuid'),
+        name=record.get('name'),
+        last_updated=record.get('lastUpdated'),
+        config_type=value.get('config_type', 'user'),
+        group_name=value.get('group_name'),
+        users=tuple(users) if isinstance(users, list) else (users,),
+        mem_limit=value.get('mem_limit'),
+        mem_limit_bytes=parse_size(value.get('mem_limit'), '{} mem_limit'.format(where)),
+        cpu_limit=parse_float(value.get('cpu_limit'), '{} cpu_limit'.format(where)),
+        images=tuple(compile_image(image, where) for image in value.get('images') or ()),
+        volume_mounts=tuple(compile_volume_mount(mount, where) for mount in value.get('volume_mounts') or ()),
+    )
+
+
+def compile_resource_profile(tenant_config, user_configs):
+    """Merge the tenant config with a user's group and user records into a ResourceProfile.
+
+    Memory is compared in bytes and cpu numerically. Layers without a limit are ignored.
+    """
+    mem_limit, mem_limit_bytes = tenant_config.mem_limit, tenant_config.mem_limit_bytes
+    cpu_limit = tenant_config.cpu_limit
+    for layer in user_configs:
+        if layer.mem_limit_bytes is not None and layer.mem_limit_bytes > mem_limit_bytes:
+            mem_limit, mem_limit_bytes = layer.mem_limit, layer.mem_limit_bytes
+        if layer.cpu_limit is not None and layer.cpu_limit > cpu_limit:
+            cpu_limit = layer.cpu_limit
+    return ResourceProfile(
+        mem_limit=mem_limit,
+        mem_limit_bytes=mem_limit_bytes,
+        cpu_limit=cpu_limit,
+        num_threads=str(max(1, int(cpu_limit))),
+    )
@@ -16,73 +16,674 @@ You can run this as a service managed by JupyterHub with this in your config::
 Or run it manually by generating an API token and storing it in `JUPYTERHUB_API_TOKEN`:
     export JUPYTERHUB_API_TOKEN=`jupyterhub token`
     python cull_idle_servers.py [--timeout=900] [--url=http://127.0.0.1:8081/hub/api]
+
+With --mode=sweep (the default) all users are checked every `cull_every` seconds. With
+--mode=deadline each server is culled when its idle deadline passes; see DeadlineCuller.
+
+With --activity=kernels a server's idle time comes from its kernels and its pod's CPU use instead of
+the hub's last_activity; see kernel_activity.
+
+With --pressure=kubernetes the sweep also culls servers idle for less than --timeout while the
+cluster is short of memory; see PressurePolicy.
+
+To tune --timeout and --cull_every, record what the sweep (or the deadline resync) sees with
+--record=activity.jsonl, then replay it offline through the same decision code:
+    python cull_idle.py --simulate=activity.jsonl --simulate_timeouts=900,1800,3600 [--cull_every=300]
+Each line of the file is {"time": <epoch seconds or ISO date>, "users": [<hub API user models>]};
+lines with the same time are parts of one snapshot. See simulate.
 """
 
 import datetime
+import heapq
 import json
 import os
+import time
+import urllib.parse
+from collections import namedtuple
 
 from dateutil.parser import parse as parse_date
 
+from tornado import gen
 from tornado.gen import coroutine
 from tornado.log import app_log
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+from tornado.httputil import url_concat
 from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.locks import Lock, Semaphore
 from tornado.options import define, options, parse_command_line
 
+# status codes worth retrying: throttled, hub or proxy errors, and tornado's 599 for timeouts and
+# connection errors. Connection errors the HTTP client raises as they are (e.g. ConnectionRefusedError
+# while the hub restarts) are retried as well.
+RETRY_STATUS = (429, 500, 502, 503, 504, 599)
+RETRY_ERRORS = (OSError, StreamClosedError)
+# the proxy in front of the single-user servers listens on this port of the hub's host (kube/service.yml).
+PROXY_PORT = 8000
+
+
+def to_timestamp(date):
+    """Epoch seconds of a hub API date; dates without a timezone are UTC."""
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+class HubAPI(object):
+    """The parts of the JupyterHub REST API used by the culler, with timeouts and retries."""
+
+    def __init__(self, url, api_token, request_timeout=30, max_retries=3, backoff=1.0):
+        self.url = url
+        self.auth_header = {
+            'Authorization': 'token %s' % api_token
+        }
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.client = AsyncHTTPClient()
+
+    @coroutine
+    def fetch(self, path, method='GET', params=None):
+        """Request `path`, retrying failed requests with exponential backoff. Returns the decoded body."""
+        req = HTTPRequest(url=url_concat(self.url + path, params),
+                          method=method,
+                          headers=self.auth_header,
+                          request_timeout=self.request_timeout,
+                          )
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = yield self.client.fetch(req)
+                break
+            except (HTTPError,) + RETRY_ERRORS as e:
+                if isinstance(e, HTTPError) and e.code not in RETRY_STATUS or attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                app_log.warning("%s %s failed (%s), retrying in %.1fs", method, req.url, e, delay)
+                yield gen.sleep(delay)
+        return json.loads(resp.body.decode('utf8', 'replace')) if resp.body else None
+
+    @coroutine
+    def list_users(self, offset, limit, state=None):
+        """One page of users. `state='active'` only returns users with a running server."""
+        params = {'offset': offset, 'limit': limit}
+        if state:
+            params['state'] = state
+        users = yield self.fetch('/users', params=params)
+        return users
+
+    @coroutine
+    def get_user(self, name):
+        """The user model of `name`, or None if there is no such user."""
+        try:
+            user = yield self.fetch('/users/%s' % name)
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        return user
+
+
+def end_of_users(users, seen):
+    """Whether paging through the user list is done, adding the names in `users` to `seen`.
+
+    A short page does not mean the end: the hub caps `limit` at its api_page_max_limit (200 by
+    default). The list ends with an empty page, or with a page of users seen before, from hubs
+    without pagination support, which return every user for every offset.
+    """
+    names = [user['name'] for user in users]
+    if all(name in seen for name in names):
+        return True
+    seen.update(names)
+    return False
+
+
+@coroutine
+def cull_user(hub, user, last_activity, cull_users):
+    """Stop the server of `user`, and delete the user if `cull_users`. Returns whether that worked."""
+    try:
+        # shutdown server first. Hub doesn't allow deleting users with running servers.
+        if user['server']:
+            app_log.info("Culling server for %s (inactive since %s)", user['name'], last_activity)
+            yield hub.fetch('/users/%s/server' % user['name'], method='DELETE')
+        if cull_users:
+            app_log.info("Culling user %s (inactive since %s)", user['name'], last_activity)
+            yield hub.fetch('/users/%s' % user['name'], method='DELETE')
+    except HTTPError as e:
+        if e.code != 404:
+            app_log.error("Failed to cull %s: %s", user['name'], e)
+            return False
+    except Exception as e:
+        app_log.error("Failed to cull %s: %s", user['name'], e)
+        return False
+    app_log.debug("Finished culling %s", user['name'])
+    return True
+
+
+_kube_api = None
+
+
+def get_kube_api():
+    """CoreV1Api and CustomObjectsApi clients authenticated with the pod's service account."""
+    global _kube_api
+    if _kube_api is None:
+        from kubernetes import client, config
+        config.load_incluster_config()
+        _kube_api = (client.CoreV1Api(), client.CustomObjectsApi())
+    return _kube_api
+
+
+def kernel_activity(hub_last_activity, kernels, cpu_cores, cpu_threshold, now):
+    """When a server was last really in use, in epoch seconds.
+
+    A busy kernel, or CPU use above `cpu_threshold` cores, means now. Otherwise it is the latest
+    kernel last_activity, so an open browser tab alone does not keep the server alive. Without
+    kernel information (no kernels, or the server did not answer) it is the hub's last_activity.
+    """
+    if cpu_cores is not None and cpu_cores > cpu_threshold:
+        return now
+    if kernels:
+        if any(kernel.get('execution_state') == 'busy' for kernel in kernels):
+            return now
+        stamps = [to_timestamp(parse_date(kernel['last_activity'])) for kernel in kernels
+                  if kernel.get('last_activity')]
+        if stamps:
+            return max(stamps)
+    return hub_last_activity
+
+
+class ActivityProbe(object):
+    """Reads the kernels of each single-user server and the CPU use of its pod.
+
+    Servers are reached through the proxy at `server_url`, with the hub API's HTTP client and token,
+    at most `concurrency` at a time. CPU use comes from one metrics.k8s.io listing of the namespace
+    per `refresh`; `refresh_stale` only reads it again once it is `cpu_max_age` seconds old.
+    """
+
+    def __init__(self, hub, server_url, namespace, cpu_threshold=0.1, concurrency=10, cpu_max_age=30):
+        self.hub = hub
+        self.server_url = server_url.rstrip('/')
+        self.namespace = namespace
+        self.cpu_threshold = cpu_threshold
+        self.cpu_max_age = cpu_max_age
+        self.semaphore = Semaphore(concurrency)
+        self._cpu = {}
+        self._cpu_read_at = 0
+        self._refresh_lock = Lock()
+
+    def _read_cpu(self):
+        from kubernetes.utils import parse_quantity
+        core, custom = get_kube_api()
+        pods = core.list_namespaced_pod(self.namespace, label_selector='component=singleuser-server')
+        usernames = {pod.metadata.name: (pod.metadata.annotations or {}).get('hub.jupyter.org/username')
+                     for pod in pods.items}
+        metrics = custom.list_namespaced_custom_object('metrics.k8s.io', 'v1beta1', self.namespace, 'pods')
+        cpu = {}
+        for item in metrics['items']:
+            username = usernames.get(item['metadata']['name'])
+            if username:
+                cpu[username] = float(sum(parse_quantity(c['usage']['cpu']) for c in item['containers']))
+        return cpu
+
+    @coroutine
+    def refresh(self):
+        """Read the current CPU use of all single-user pods."""
+        try:
+            self._cpu = yield IOLoop.current().run_in_executor(None, self._read_cpu)
+        except Exception as e:
+            app_log.error("Could not read pod metrics, deciding on kernels only: %s", e)
+            self._cpu = {}
+        self._cpu_read_at = time.time()
+
+    @coroutine
+    def refresh_stale(self):
+        """`refresh`, unless the CPU use was read less than `cpu_max_age` seconds ago."""
+        with (yield self._refresh_lock.acquire()):
+            if time.time() - self._cpu_read_at > self.cpu_max_age:
+                yield self.refresh()
+
+    @coroutine
+    def kernels(self, user):
+        """The kernels of the user's server, or None if the server does not answer."""
+        req = HTTPRequest(url=self.server_url + user['server'] + 'api/kernels',
+                          headers=self.hub.auth_header,
+                          request_timeout=self.hub.request_timeout,
+                          )
+        with (yield self.semaphore.acquire()):
+            try:
+                resp = yield self.hub.client.fetch(req)
+            except Exception as e:
+                app_log.warning("Could not list kernels of %s, using the hub's last_activity: %s", user['name'], e)
+                return None
+        return json.loads(resp.body.decode('utf8', 'replace'))
+
+    @coroutine
+    def probe(self, users):
+        """{name: last real activity as a datetime} for users with a running server."""
+        users = [user for user in users if user['server'] and user.get('last_activity')]
+        kernels = yield [self.kernels(user) for user in users]
+        now = time.time()
+        activity = {}
+        for user, user_kernels in zip(users, kernels):
+            stamp = kernel_activity(to_timestamp(parse_date(user['last_activity'])), user_kernels,
+                                    self._cpu.get(user['name']), self.cpu_threshold, now)
+            activity[user['name']] = datetime.datetime.fromtimestamp(stamp, datetime.timezone.utc)
+        return activity
+
+
+class PressureSnapshot(namedtuple('PressureSnapshot', ['memory_allocatable', 'memory_committed', 'user_memory'])):
+    """Cluster memory in bytes: allocatable on schedulable nodes, committed to pods, and per notebook user."""
+    __slots__ = ()
+
+    @property
+    def pressure(self):
+        return self.memory_committed / self.memory_allocatable if self.memory_allocatable else 0.0
+
+
+class StaticPressureSource(object):
+    """A fixed memory pressure, for tests and for running the culler outside the cluster."""
+
+    def __init__(self, pressure, user_memory=None, memory_allocatable=2 ** 40):
+        self.pressure = pressure
+        self.user_memory = dict(user_memory or {})
+        self.memory_allocatable = memory_allocatable
+
+    @coroutine
+    def snapshot(self):
+        return PressureSnapshot(self.memory_allocatable, self.pressure * self.memory_allocatable,
+                                dict(self.user_memory))
+
+
+class KubernetesPressureSource(object):
+    """Memory pressure read from the Kubernetes API with the pod's service account.
+
+    A container commits the larger of its memory request and limit: the spawner hooks set a
+    near-zero mem_guarantee, so requests alone would show an empty cluster.
+    """
+
+    def _read(self):
+        from kubernetes.utils import parse_quantity
+        core, _ = get_kube_api()
+        allocatable = sum(parse_quantity(node.status.allocatable['memory']) for node in core.list_node().items
+                          if not node.spec.unschedulable)
+        committed = 0
+        user_memory = {}
+        pods = core.list_pod_for_all_namespaces(field_selector='status.phase!=Succeeded,status.phase!=Failed')
+        for pod in pods.items:
+            memory = 0
+            for container in pod.spec.containers:
+                resources = container.resources
+                memory += max(parse_quantity((resources.requests or {}).get('memory', 0)),
+                              parse_quantity((resources.limits or {}).get('memory', 0)))
+            committed += memory
+            if (pod.metadata.labels or {}).get('component') == 'singleuser-server':
+                username = (pod.metadata.annotations or {}).get('hub.jupyter.org/username')
+                if username:
+                    user_memory[username] = memory
+        return PressureSnapshot(float(allocatable), float(committed), user_memory)
+
+    @coroutine
+    def snapshot(self):
+        snapshot = yield IOLoop.current().run_in_executor(None, self._read)
+        return snapshot
+
+
+class PressurePolicy(object):
+    """Shortens the idle timeout while the cluster is short of memory.
+
+    Up to a pressure (committed / allocatable memory) of `low` the timeout is unchanged. From there
+    it shrinks linearly, down to `min_timeout_fraction` of the timeout at a pressure of `high`.
+    Servers idle longer than the shortened timeout, but not the full one, are culled in order of
+    idle seconds times memory, so the longest idle and largest servers go first. Culling stops as soon
+    as the freed memory brings the pressure back down to `low`.
+    """
+
+    def __init__(self, low=0.8, high=0.95, min_timeout_fraction=0.25):
+        self.low = low
+        self.high = high
+        self.min_timeout_fraction = min_timeout_fraction
+
+    def effective_timeout(self, timeout, pressure):
+        if pressure <= self.low:
+            return timeout
+        fraction = min((pressure - self.low) / (self.high - self.low), 1.0)
+        return timeout * (1 - fraction * (1 - self.min_timeout_fraction))
+
+    def select(self, candidates, snapshot, timeout, now):
+        """Names to cull early, in order, from `candidates`: (name, last activity in epoch seconds) pairs."""
+        effective = self.effective_timeout(timeout, snapshot.pressure)
+        eligible = [(name, now - last_activity) for name, last_activity in candidates
+                    if now - last_activity > effective]
+        eligible.sort(key=lambda c: (c[1] * snapshot.user_memory.get(c[0], 0), c[1]), reverse=True)
+        committed = snapshot.memory_committed
+        selected = []
+        for name, idle in eligible:
+            if committed <= self.low * snapshot.memory_allocatable:
+                break
+            selected.append(name)
+            committed -= snapshot.user_memory.get(name, 0)
+        return selected
+
+
+def cull_decision(user, last_activity, cull_limit, pressure_limit, cull_users):
+    """What the sweep does with a user model: 'skip', 'cull', 'early' (cull if memory pressure
+    requires it) or 'keep'. `last_activity` and the limits are epoch seconds."""
+    if not user['server'] and not cull_users:
+        # server not running and not culling users, nothing to do
+        return 'skip'
+    if last_activity is None:
+        return 'skip'
+    if last_activity < cull_limit:
+        return 'cull'
+    if last_activity < pressure_limit:
+        return 'early'
+    return 'keep'
+
 
 @coroutine
-def cull_idle(url, api_token, timeout, cull_users=False):
+def cull_idle(hub, timeout, cull_users=False, page_size=200, concurrency=10, pressure_source=None, policy=None,
+              activity_probe=None, recorder=None):
     """Shutdown idle single-user servers
     If cull_users, inactive *users* will be deleted as well.
+
+    Users are read `page_size` at a time and each page is culled before the next one is fetched,
+    with at most `concurrency` DELETE requests in flight. With a `pressure_source`, servers idle for
+    less than `timeout` are collected while paging and culled at the end as `policy` selects them.
+    With an `activity_probe`, idle time is measured from each server's kernel and CPU activity.
+    `recorder`, if given, is called with the sweep time and each page of users.
     """
-    auth_header = {
-        'Authorization': 'token %s' % api_token
-    }
-    req = HTTPRequest(url=url + '/users',
-                      headers=auth_header,
-                      )
     now = datetime.datetime.utcnow()
     cull_limit = now - datetime.timedelta(seconds=timeout)
     app_log.info("Current cull limit now ( %s) is  %s", now, cull_limit)
-    client = AsyncHTTPClient()
-    resp = yield client.fetch(req)
-    users = json.loads(resp.body.decode('utf8', 'replace'))
-    futures = []
+    semaphore = Semaphore(concurrency)
+
+    snapshot = None
+    pressure_limit = to_timestamp(cull_limit)
+    if pressure_source is not None:
+        policy = policy or PressurePolicy()
+        try:
+            snapshot = yield pressure_source.snapshot()
+        except Exception as e:
+            app_log.error("Could not read cluster memory pressure, using the full timeout: %s", e)
+        else:
+            pressure_limit = time.time() - policy.effective_timeout(timeout, snapshot.pressure)
+            app_log.info("Memory pressure %.2f, idle timeout %is", snapshot.pressure,
+                         policy.effective_timeout(timeout, snapshot.pressure))
+    early_candidates = {}
+    if activity_probe is not None:
+        yield activity_probe.refresh()
 
     @coroutine
     def cull_one(user, last_activity):
         """cull one user"""
+        with (yield semaphore.acquire()):
+            culled = yield cull_user(hub, user, last_activity, cull_users)
+            return culled
 
-        # shutdown server first. Hub doesn't allow deleting users with running servers.
-        if user['server']:
-            app_log.info("Culling server for %s (inactive since %s)", user['name'], last_activity)
-            req = HTTPRequest(url=url + '/users/%s/server' % user['name'],
-                              method='DELETE',
-                              headers=auth_header,
-                              )
-            yield client.fetch(req)
-        if cull_users:
-            app_log.info("Culling user %s (inactive since %s)", user['name'], last_activity)
-            req = HTTPRequest(url=url + '/users/%s' % user['name'],
-                              method='DELETE',
-                              headers=auth_header,
-                              )
-            yield client.fetch(req)
-
-    for user in users:
-        if not user['server'] and not cull_users:
-            # server not running and not culling users, nothing to do
-            continue
-        last_activity = parse_date(user['last_activity'])
-        if last_activity < cull_limit:
-            futures.append((user['name'], cull_one(user, last_activity)))
-        else:
-            app_log.debug("Not culling %s (active since %s)", user['name'], last_activity)
+    offset = 0
+    page_number = 0
+    total_seen = total_culled = total_failed = 0
+    seen = set()
+    culled_names = []
+    while True:
+        users = yield hub.list_users(offset, page_size)
+        if end_of_users(users, seen):
+            break
+        page_number += 1
+        if recorder is not None:
+            recorder(to_timestamp(now), users)
+        activity = (yield activity_probe.probe(users)) if activity_probe is not None else {}
+
+        futures = []
+        names = []
+        for user in users:
+            last_activity = activity.get(user['name'])
+            if last_activity is None and user.get('last_activity'):
+                last_activity = parse_date(user['last_activity'])
+            # the hub sends UTC dates with a 'Z' suffix, which cannot be compared with utcnow() directly.
+            decision = cull_decision(user, to_timestamp(last_activity) if last_activity else None,
+                                     to_timestamp(cull_limit), pressure_limit, cull_users)
+            if decision == 'cull':
+                futures.append(cull_one(user, last_activity))
+                names.append(user['name'])
+            elif decision == 'early':
+                early_candidates[user['name']] = (user, last_activity)
+            elif decision == 'keep':
+                app_log.debug("Not culling %s (active since %s)", user['name'], last_activity)
+        results = yield futures
+        culled_names += [name for name, r in zip(names, results) if r]
+        culled = sum(1 for r in results if r)
+        total_seen += len(users)
+        total_culled += culled
+        total_failed += len(results) - culled
+        app_log.info("Page %i: %i users, culled %i, failed %i (total %i users, %i culled, %i failed)",
+                     page_number, len(users), culled, len(results) - culled, total_seen, total_culled, total_failed)
+
+        # deleted users no longer take up a place in the list.
+        offset += len(users) - (culled if cull_users else 0)
+
+    if early_candidates:
+        # the servers culled above no longer hold their memory.
+        snapshot = snapshot._replace(memory_committed=snapshot.memory_committed -
+                                     sum(snapshot.user_memory.get(name, 0) for name in culled_names))
+        names = policy.select([(name, to_timestamp(last_activity)) for name, (_, last_activity)
+                               in early_candidates.items()], snapshot, timeout, time.time())
+        app_log.info("Culling %i of %i servers early because of memory pressure", len(names), len(early_candidates))
+        yield [cull_one(*early_candidates[name]) for name in names]
+
+
+def load_snapshots(path):
+    """Read a recorded activity log into a list of (epoch seconds, {name: user model}), oldest first."""
+    snapshots = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            when = record['time']
+            if not isinstance(when, (int, float)):
+                when = to_timestamp(parse_date(when))
+            snapshots.setdefault(when, {}).update((user['name'], user) for user in record['users'])
+    return sorted(snapshots.items())
 
-    for (name, f) in futures:
-        yield f
-        app_log.debug("Finished culling %s", name)
+
+def simulate(snapshots, timeout, cull_every, mem_gb, cull_users=False):
+    """Replay recorded snapshots through `cull_decision` with a sweep every `cull_every` seconds.
+
+    A server the policy culls stays stopped until the recording shows activity after the cull: that
+    is a mid-session cull, after which the user is assumed to start a new server. Every sweep interval
+    a server spends culled but running in the recording saves `mem_gb` for that long.
+    """
+    result = {'timeout': timeout, 'culls': 0, 'mid_session_culls': 0, 'users_interrupted': set(),
+              'peak_recorded': 0, 'peak_simulated': 0, 'gb_hours_saved': 0.0}
+    if not snapshots:
+        return result
+    culled = {}
+    index = 0
+    now = snapshots[0][0]
+    while now <= snapshots[-1][0]:
+        while index + 1 < len(snapshots) and snapshots[index + 1][0] <= now:
+            index += 1
+        users = snapshots[index][1]
+        # deadline mode only records users with a running server; a missing user's session ended.
+        for name in set(culled) - set(users):
+            del culled[name]
+        for name, user in users.items():
+            last_activity = to_timestamp(parse_date(user['last_activity'])) if user.get('last_activity') else None
+            if name in culled:
+                if not user['server']:
+                    # the recorded session ended too.
+                    del culled[name]
+                elif last_activity is not None and last_activity > culled[name]:
+                    result['mid_session_culls'] += 1
+                    result['users_interrupted'].add(name)
+                    del culled[name]
+                else:
+                    result['gb_hours_saved'] += mem_gb * cull_every / 3600.0
+                    continue
+            limit = now - timeout
+            if user['server'] and cull_decision(user, last_activity, limit, limit, cull_users) == 'cull':
+                culled[name] = now
+                result['culls'] += 1
+        recorded = sum(1 for user in users.values() if user['server'])
+        result['peak_recorded'] = max(result['peak_recorded'], recorded)
+        result['peak_simulated'] = max(result['peak_simulated'],
+                                       sum(1 for name, user in users.items() if user['server'] and name not in culled))
+        now += cull_every
+    return result
+
+
+def print_simulation(path, timeouts, cull_every, mem_gb, cull_users=False):
+    snapshots = load_snapshots(path)
+    if not snapshots:
+        print("No snapshots in %s" % path)
+        return
+    print("%i snapshots from %s to %s, sweep every %is, %.1f GB per server" % (
+        len(snapshots), datetime.datetime.utcfromtimestamp(snapshots[0][0]),
+        datetime.datetime.utcfromtimestamp(snapshots[-1][0]), cull_every, mem_gb))
+    print("%10s %8s %10s %10s %10s %12s %12s" % ('timeout', 'culls', 'mid-sess.', 'users', 'peak rec.',
+                                                   'peak sim.', 'GB-h saved'))
+    for timeout in timeouts:
+        r = simulate(snapshots, timeout, cull_every, mem_gb, cull_users)
+        print("%10i %8i %10i %10i %10i %12i %12.1f" % (r['timeout'], r['culls'], r['mid_session_culls'],
+                                                         len(r['users_interrupted']), r['peak_recorded'],
+                                                         r['peak_simulated'], r['gb_hours_saved']))
+
+
+class DeadlineCuller(object):
+    """Culls each server when its idle deadline passes, instead of sweeping all users periodically.
+
+    The deadlines (last_activity + timeout) of running servers sit in a min-heap and the loop sleeps
+    until the earliest one. A due user is fetched again before culling, because the server may have
+    been used since the deadline was computed; in that case it goes back on the heap with its new
+    deadline. New servers and activity are picked up by a resync every `resync_every` seconds that
+    only lists users with a running server (`?state=active`) and only reschedules users whose
+    last_activity changed. Users that cannot be checked or culled are checked again `retry` seconds
+    later.
+
+    With an `activity_probe` the recheck of a due server uses its kernel and CPU activity, so
+    servers kept alive only by an open browser tab are culled at their next hub deadline.
+
+    `recorder`, if given, is called with the resync time and each page of users, like in `cull_idle`.
+    """
+
+    def __init__(self, hub, timeout, resync_every, cull_users=False, page_size=200, concurrency=10,
+                 activity_probe=None, retry=60, recorder=None):
+        self.hub = hub
+        self.recorder = recorder
+        self.retry = retry
+        self.activity_probe = activity_probe
+        self.timeout = timeout
+        self.resync_every = resync_every
+        self.cull_users = cull_users
+        self.page_size = page_size
+        self.semaphore = Semaphore(concurrency)
+        self._heap = []
+        self._deadlines = {}
+        self._retrying = set()
+
+    def schedule(self, name, last_activity):
+        deadline = to_timestamp(last_activity) + self.timeout
+        if name in self._retrying:
+            # a failed check waits for its retry unless the server was used since.
+            deadline = max(deadline, self._deadlines[name])
+        if self._deadlines.get(name) != deadline:
+            self._deadlines[name] = deadline
+            heapq.heappush(self._heap, (deadline, name))
+
+    @coroutine
+    def resync(self):
+        # without cull_users only running servers can be culled, so only those are listed.
+        state = None if self.cull_users else 'active'
+        if self.activity_probe is not None:
+            yield self.activity_probe.refresh()
+        now = time.time()
+        listed = set()
+        seen = set()
+        offset = 0
+        while True:
+            users = yield self.hub.list_users(offset, self.page_size, state=state)
+            if end_of_users(users, listed):
+                break
+            if self.recorder is not None:
+                self.recorder(now, users)
+            for user in users:
+                if (not user['server'] and not self.cull_users) or not user.get('last_activity'):
+                    continue
+                seen.add(user['name'])
+                self.schedule(user['name'], parse_date(user['last_activity']))
+            offset += len(users)
+        if self.recorder is not None and not listed:
+            # record that no server is running, so replays do not keep the previous snapshot.
+            self.recorder(now, [])
+        for name in set(self._deadlines) - seen:
+            del self._deadlines[name]
+            self._retrying.discard(name)
+        app_log.info("Tracking idle deadlines of %i users", len(self._deadlines))
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, name = heapq.heappop(self._heap)
+            # skip heap entries superseded by a later deadline, and users that are gone.
+            if self._deadlines.get(name) == deadline:
+                due.append(name)
+        return due
+
+    def retry_later(self, name):
+        deadline = time.time() + self.retry
+        self._retrying.add(name)
+        self._deadlines[name] = deadline
+        heapq.heappush(self._heap, (deadline, name))
+
+    @coroutine
+    def check(self, name):
+        """Cull `name` if the server is still idle, otherwise schedule its new deadline.
+
+        If the user cannot be checked or culled, `name` is checked again `retry` seconds later.
+        """
+        with (yield self.semaphore.acquire()):
+            self._retrying.discard(name)
+            try:
+                user = yield self.hub.get_user(name)
+                if user is None or (not user['server'] and not self.cull_users) or not user.get('last_activity'):
+                    self._deadlines.pop(name, None)
+                    return
+                last_activity = parse_date(user['last_activity'])
+                if self.activity_probe is not None:
+                    # a job started since the last resync only shows up in fresh CPU use.
+                    yield self.activity_probe.refresh_stale()
+                    activity = yield self.activity_probe.probe([user])
+                    last_activity = activity.get(name, last_activity)
+                if to_timestamp(last_activity) + self.timeout > time.time():
+                    app_log.debug("Not culling %s (active since %s)", name, last_activity)
+                    self.schedule(name, last_activity)
+                    return
+                culled = yield cull_user(self.hub, user, last_activity, self.cull_users)
+            except Exception as e:
+                app_log.error("Could not check %s, retrying in %is: %s", name, self.retry, e)
+                culled = False
+            if culled:
+                self._deadlines.pop(name, None)
+            else:
+                self.retry_later(name)
+
+    @coroutine
+    def run(self):
+        next_resync = 0
+        while True:
+            if time.time() >= next_resync:
+                try:
+                    yield self.resync()
+                except Exception as e:
+                    app_log.error("Could not list users: %s", e)
+                next_resync = time.time() + self.resync_every
+            due = self._pop_due(time.time())
+            if due:
+                app_log.info("Checking %i servers past their idle deadline", len(due))
+                yield [self.check(name) for name in due]
+                continue
+            wake = min(self._heap[0][0], next_resync) if self._heap else next_resync
+            yield gen.sleep(max(wake - time.time(), 0))
 
 
 if __name__ == '__main__':
@@ -93,20 +694,85 @@ if __name__ == '__main__':
            help="""Cull users in addition to servers.
                 This is for use in temporary-user cases such as tmpnb.""",
            )
+    define('page_size', default=200, help="Number of users fetched from the hub API per request")
+    define('concurrency', default=10, help="Maximum number of cull requests in flight")
+    define('max_retries', default=3, help="Retries of a failed hub API request")
+    define('backoff', default=1.0, help="Seconds before the first retry; doubled for every further retry")
+    define('request_timeout', default=30, help="Timeout (in seconds) of each hub API request")
+    define('pressure', default='off',
+           help="""Memory pressure source for the sweep: off, kubernetes, or a fixed pressure such as 0.9.""",
+           )
+    define('pressure_low', default=0.8, help="Memory pressure above which the idle timeout is shortened")
+    define('pressure_high', default=0.95, help="Memory pressure at which the idle timeout is shortest")
+    define('pressure_min_timeout', default=0.25, help="Shortest idle timeout, as a fraction of --timeout")
+    define('activity', default='hub',
+           help="""Idleness signal: hub (the hub's last_activity) or kernels (kernel state and pod CPU use).""",
+           )
+    define('server_url', default=os.environ.get('CULL_SERVER_URL'),
+           help="""URL of the proxy the single-user servers are reached through, for --activity=kernels.
+                Defaults to port %i of the --url host.""" % PROXY_PORT)
+    define('namespace', default=os.environ.get('POD_NAMESPACE', 'default'),
+           help="Namespace of the single-user pods, for --activity=kernels")
+    define('cpu_threshold', default=0.1, help="CPU cores above which a server counts as busy")
+    define('record', default=None,
+           help="Append every user list the sweep or the deadline resync reads to this file, for --simulate")
+    define('simulate', default=None, help="Replay a file written by --record instead of culling")
+    define('simulate_timeouts', default=[], type=int, multiple=True,
+           help="Timeouts (in seconds) to compare with --simulate; defaults to --timeout")
+    define('simulate_mem_gb', default=3.0, help="Memory of a server (in GB) for the GB-hours saved by --simulate")
+    define('mode', default='sweep',
+           help="""sweep: check all users every cull_every seconds.
+                deadline: cull each server at its idle deadline, listing running servers every cull_every seconds.""",
+           )
 
     parse_command_line()
     if not options.cull_every:
         options.cull_every = options.timeout // 2
+    if not options.server_url and options.url:
+        hub_url = urllib.parse.urlsplit(options.url)
+        options.server_url = '%s://%s:%i' % (hub_url.scheme, hub_url.hostname, PROXY_PORT)
+
+    if options.simulate:
+        print_simulation(options.simulate, options.simulate_timeouts or [options.timeout], options.cull_every,
+                         options.simulate_mem_gb, options.cull_users)
+        raise SystemExit(0)
 
     api_token = os.environ['JUPYTERHUB_API_TOKEN']
+    hub = HubAPI(options.url, api_token, options.request_timeout, options.max_retries, options.backoff)
+
+    activity_probe = None
+    if options.activity == 'kernels':
+        activity_probe = ActivityProbe(hub, options.server_url, options.namespace, options.cpu_threshold,
+                                       options.concurrency)
+
+    recorder = None
+    if options.record:
+        record_file = open(options.record, 'a')
+
+        def recorder(when, users):
+            record_file.write(json.dumps({'time': when, 'users': users}) + '\n')
+            record_file.flush()
 
     loop = IOLoop.current()
-    cull = lambda: cull_idle(options.url, api_token, options.timeout, options.cull_users)
-    # run once before scheduling periodic call
-    loop.run_sync(cull)
-    # schedule periodic cull
-    pc = PeriodicCallback(cull, 1e3 * options.cull_every)
-    pc.start()
+    if options.mode == 'deadline':
+        culler = DeadlineCuller(hub, options.timeout, options.cull_every, options.cull_users, options.page_size,
+                                options.concurrency, activity_probe, recorder=recorder)
+        loop.spawn_callback(culler.run)
+    else:
+        if options.pressure == 'off':
+            pressure_source = None
+        elif options.pressure == 'kubernetes':
+            pressure_source = KubernetesPressureSource()
+        else:
+            pressure_source = StaticPressureSource(float(options.pressure))
+        policy = PressurePolicy(options.pressure_low, options.pressure_high, options.pressure_min_timeout)
+        cull = lambda: cull_idle(hub, options.timeout, options.cull_users, options.page_size, options.concurrency,
+                                 pressure_source, policy, activity_probe, recorder)
+        # run once before scheduling periodic call
+        loop.run_sync(cull)
+        # schedule periodic cull
+        pc = PeriodicCallback(cull, 1e3 * options.cull_every)
+        pc.start()
     try:
         loop.start()
     except KeyboardInterrupt:
@@ -87,11 +87,14 @@ c.JupyterHub.admin_access = True
 c.JupyterHub.authenticator_class = 'oauthenticator.agave.AgaveOAuthenticator'
 # c.JupyterHub.authenticator_class = 'jupyterhub.auth.DummyAuthenticator' #for testing
 
-c.AgaveOAuthenticator.oauth_callback_url = CONFIGS['oauth_callback_url']
-c.AgaveOAuthenticator.client_id = CONFIGS['agave_client_id']
-c.AgaveOAuthenticator.client_secret = CONFIGS['agave_client_secret']
-c.AgaveOAuthenticator.authorize_url = "{}/oauth2/authorize".format(CONFIGS.get('agave_base_url').rstrip('/'))
-c.Authenticator.admin_users = CONFIGS.get('admin_users', [])
+c.AgaveOAuthenticator.oauth_callback_url = CONFIGS.oauth_callback_url
+c.AgaveOAuthenticator.client_id = CONFIGS.agave_client_id
+c.AgaveOAuthenticator.client_secret = CONFIGS.agave_client_secret
+c.AgaveOAuthenticator.authorize_url = "{}/oauth2/authorize".format(CONFIGS.agave_base_url)
+c.Authenticator.admin_users = set(CONFIGS.admin_users)
+# keep each user's Agave tokens in the encrypted auth_state, where the spawner hooks read them.
+# needs JUPYTERHUB_CRYPT_KEY; without it the hooks fall back to the token files.
+c.Authenticator.enable_auth_state = bool(os.environ.get('JUPYTERHUB_CRYPT_KEY'))
 
 
 ## The base URL of the entire application.
@@ -195,6 +198,8 @@ c.Authenticator.admin_users = CONFIGS.get('admin_users', [])
 #
 #  The Hub prefix will be added, so `/my-page` will be served at `/hub/my-page`.
 #c.JupyterHub.extra_handlers = []
+from jupyterhub.admin_api import default_handlers as admin_api_handlers
+c.JupyterHub.extra_handlers = admin_api_handlers
 
 ## DEPRECATED: use output redirection instead, e.g.
 #
@@ -374,7 +379,7 @@ c.JupyterHub.hub_ip = '0.0.0.0' #listen on all interfaces
 #              'environment':
 #          }
 #      ]
-c.JupyterHub.services = CONFIGS.get('services', [])
+c.JupyterHub.services = [dict(service) for service in CONFIGS.services]
 
 ## The class to use for spawning single-user servers.
 #
@@ -941,6 +946,7 @@ c.KubeSpawner.delete_stopped_pods = False
 # c.KubeSpawner.args = ['--allow-root']
 
 #setup
-from jupyterhub.spawner_hooks import hook, get_notebook_options
+from jupyterhub.spawner_hooks import hook, get_notebook_options, stop_hook
 c.KubeSpawner.pre_spawn_hook = hook
+c.KubeSpawner.post_stop_hook = stop_hook
 c.KubeSpawner.options_form = get_notebook_options
\ No newline at end of file
@@ -6,6 +6,7 @@ users = [
 ]
 
 import os
+import time
 
 from kubernetes import client
 from pprint import pprint
@@ -53,24 +54,46 @@ def submit_form(driver):
         print('What happened here {} '.format(driver.page_source))
 
 
+def get_kube_api():
+    with open('/run/secrets/kubernetes.io/serviceaccount/token') as f:
+        token = f.read()
+    with open('/run/secrets/kubernetes.io/serviceaccount/namespace') as f:
+        namespace = f.read()
+
+    configuration = client.Configuration()
+    configuration.api_key['authorization'] = 'Bearer {}'.format(token)
+    configuration.host = 'https://kubernetes.default'
+    configuration.ssl_ca_cert = '/run/secrets/kubernetes.io/serviceaccount/ca.crt'
+
+    return client.CoreV1Api(client.ApiClient(configuration)), namespace
+
+
+def print_start_latency(user, spawn_seconds):
+    # compare TOKEN_DELIVERY_MODE settings: time from pod creation to Ready, and time spent in init containers.
+    try:
+        api_instance, namespace = get_kube_api()
+        pod = api_instance.read_namespaced_pod('jupyter-{}'.format(user['username']), namespace)
+    except Exception as e:
+        print("Could not read pod for {}: {}".format(user['username'], e))
+        return
+    mode = (pod.metadata.annotations or {}).get('jupyterhub.tacc.utexas.edu/token-delivery', 'unknown')
+    ready = [c.last_transition_time for c in pod.status.conditions or [] if c.type == 'Ready' and c.status == 'True']
+    pod_start = (ready[0] - pod.metadata.creation_timestamp).total_seconds() if ready else None
+    init_seconds = sum((s.state.terminated.finished_at - s.state.terminated.started_at).total_seconds()
+                       for s in pod.status.init_container_statuses or [] if s.state.terminated)
+    print('{} token delivery: {} spawn: {:.1f}s pod creation to ready: {}s init containers: {:.1f}s'.format(
+        user['username'], mode, spawn_seconds, pod_start, init_seconds))
+
+
 def get_more_info(driver, user):
     try:
         WebDriverWait(driver, 280).until(
             EC.presence_of_element_located((By.ID, 'refresh_notebook_list')))
         print('{} notebook spawned successfully'.format(user['username']))
+        return True
     except TimeoutException as e:  # notebook didn't spin up
         print('What happened here {} '.format(driver.page_source))
-        with open('/run/secrets/kubernetes.io/serviceaccount/token') as f:
-            token = f.read()
-        with open('/run/secrets/kubernetes.io/serviceaccount/namespace') as f:
-            namespace = f.read()
-
-        configuration = client.Configuration()
-        configuration.api_key['authorization'] = 'Bearer {}'.format(token)
-        configuration.host = 'https://kubernetes.default'
-        configuration.ssl_ca_cert = '/run/secrets/kubernetes.io/serviceaccount/ca.crt'
-
-        api_instance = client.CoreV1Api(client.ApiClient(configuration))
+        api_instance, namespace = get_kube_api()
 
         try:
             api_response = api_instance.read_namespaced_pod('jupyter-{}'.format(user['username']), namespace)
@@ -93,6 +116,7 @@ for account in users:
     driver = webdriver.Chrome('{}/chromedriver'.format(os.path.dirname(os.path.realpath(__file__))), options=chrome_options)
     driver.get(url)
     login(driver, user)
+    started = time.time()
     try:
         submit_form(driver)
     except NoSuchElementException as e:
@@ -104,5 +128,6 @@ for account in users:
             print("{} has no options form".format(user['username']))
     except Exception as e:
         print('😱{} {} What happened here {}'.format(user['username'], e, driver.page_source))
-    get_more_info(driver, user)
+    if get_more_info(driver, user):
+        print_start_latency(user, time.time() - started)
     driver.quit()
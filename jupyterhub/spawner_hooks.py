@@ -1,100 +1,222 @@
-import ast
-import humanfriendly
+import asyncio
+import base64
+import copy
+import hashlib
+import html
 import json
 import os
 import re
-import requests
-
-from agavepy.agave import Agave
-from jupyterhub.common import TENANT, INSTANCE, get_tenant_configs, safe_string, get_user_configs
+import shlex
+import sqlite3
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+from jupyterhub.config_schema import compile_resource_profile
+from jupyterhub.common import TENANT, INSTANCE, AGAVE_CONNECT_TIMEOUT, AGAVE_REQUEST_TIMEOUT, AgaveMetadataClient, \
+    get_configs_version, get_http_client, get_tenant_configs, get_token_configmap_name, safe_string, get_user_configs, \
+    token_refresher, TOKEN_DELIVERY_MODE
+from jupyterhub.token_store import get_token_store
 from tornado import web
+from tornado.httpclient import HTTPClientError, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+
+# the entrypoint mode wrapper copies the token files out of the live ConfigMap mount at start and
+# then every TOKEN_SYNC_INTERVAL seconds whenever the hub has written new ones.
+TOKEN_SYNC_INTERVAL = int(os.environ.get('TOKEN_SYNC_INTERVAL', 60))
+TOKEN_ENTRYPOINT = ['/bin/sh', '-c',
+                    'sync_tokens() {{ for f in current .agpy; do '
+                    'if [ "$(cat /agave_data/$f)" != "$(cat /home/jupyter/.agave/.hub$f 2>/dev/null)" ]; then '
+                    'cp /agave_data/$f /home/jupyter/.agave/$f.new && '
+                    'mv /home/jupyter/.agave/$f.new /home/jupyter/.agave/$f && '
+                    'cp /agave_data/$f /home/jupyter/.agave/.hub$f; fi; done; }}; '
+                    'sync_tokens && ln -sfn /home/jupyter/.agave/.agpy /home/jupyter/.agpy && '
+                    '{{ (while sleep {}; do sync_tokens; done) & }} && exec "$@"'.format(TOKEN_SYNC_INTERVAL),
+                    'agave-tokens']
 
 # TAS configuration:
 # base URL for TAS API.
 TAS_URL_BASE = os.environ.get('TAS_URL_BASE', 'https://tas.tacc.utexas.edu/api/v1')
 TAS_ROLE_ACCT = os.environ.get('TAS_ROLE_ACCT', 'tas-jetstream')
 TAS_ROLE_PASS = os.environ.get('TAS_ROLE_PASS')
+# local cache of TAS identities: sqlite file, seconds a record is trusted, and seconds an unknown
+# username is remembered as unknown.
+TAS_CACHE_DB = os.environ.get('TAS_CACHE_DB', '/srv/jupyterhub/tas_identity_cache.sqlite')
+TAS_CACHE_TTL = int(os.environ.get('TAS_CACHE_TTL', 60 * 60 * 24))
+TAS_CACHE_NEGATIVE_TTL = int(os.environ.get('TAS_CACHE_NEGATIVE_TTL', 60 * 5))
+# the only fields of a TAS user record the hub uses, and the only ones it keeps.
+TAS_IDENTITY_FIELDS = ('uid', 'gid', 'homeDirectory')
+
+
+def get_tas_identity(record):
+    """The identity fields of a TAS user record, leaving out the rest of the profile."""
+    if not record:
+        return None
+    return {field: record.get(field) for field in TAS_IDENTITY_FIELDS}
+
+
+class TasIdentityCache(object):
+    """Persistent cache of the TAS identity (uid, gid, homeDirectory) of each user.
+
+    Records are kept in a small sqlite file so they survive hub restarts. Usernames TAS does not know
+    are stored with a NULL record and a shorter TTL. Expired records are kept around and handed out
+    by `get_stale` when TAS cannot be reached.
+    """
+
+    def __init__(self, path, ttl, negative_ttl):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS tas_identity ('
+                             'username TEXT PRIMARY KEY, record TEXT, fetched_at REAL, expires_at REAL)')
+        return self._db
+
+    def get(self, username):
+        """Return (found, record) for a username whose entry has not expired."""
+        row = self.db.execute('SELECT record FROM tas_identity WHERE username = ? AND expires_at > ?',
+                              (username, time.time())).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0]) if row[0] else None
+
+    def get_stale(self, username):
+        row = self.db.execute('SELECT record FROM tas_identity WHERE username = ? AND record IS NOT NULL',
+                              (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, username, record):
+        now = time.time()
+        record = get_tas_identity(record)
+        ttl = self.ttl if record else self.negative_ttl
+        self.db.execute('INSERT OR REPLACE INTO tas_identity VALUES (?, ?, ?, ?)',
+                        (username, json.dumps(record) if record else None, now, now + ttl))
+
+    def purge(self, username=None):
+        """Remove the entry for `username`, or every entry when no username is given."""
+        if username is None:
+            self.db.execute('DELETE FROM tas_identity')
+        else:
+            self.db.execute('DELETE FROM tas_identity WHERE username = ?', (username,))
+
+
+tas_identity_cache = TasIdentityCache(TAS_CACHE_DB, TAS_CACHE_TTL, TAS_CACHE_NEGATIVE_TTL)
+
+# DesignSafe projects: seconds a user's project list is used without revalidation, how many users
+# are kept, and how long before its exp claim a cached X-Jwt-Assertion-Designsafe is replaced.
+PROJECTS_CACHE_TTL = int(os.environ.get('PROJECTS_CACHE_TTL', 60))
+PROJECTS_CACHE_SIZE = int(os.environ.get('PROJECTS_CACHE_SIZE', 5000))
+DESIGNSAFE_JWT_EXPIRY_MARGIN = int(os.environ.get('DESIGNSAFE_JWT_EXPIRY_MARGIN', 60))
 
+# in the subpath and symlinks project mount modes: name of the single projects volume, and where
+# the symlinks mode mounts it in the notebook.
+PROJECTS_VOLUME_NAME = 'projects-root'
+PROJECTS_SYMLINK_ROOT = os.environ.get('PROJECTS_SYMLINK_ROOT', '/home/jupyter/.projects')
 
-def hook(spawner):
+projects_cache = OrderedDict()
+designsafe_assertions = {}
+
+# number of rendered options forms kept: one per distinct (tenant config, user config) version.
+OPTIONS_FORM_CACHE_SIZE = int(os.environ.get('OPTIONS_FORM_CACHE_SIZE', 1000))
+options_forms = OrderedDict()
+# number of effective resource profiles kept, also one per (tenant config, user config) version.
+RESOURCE_PROFILE_CACHE_SIZE = int(os.environ.get('RESOURCE_PROFILE_CACHE_SIZE', 1000))
+resource_profiles = OrderedDict()
+# number of resolved volume mount plans kept, one per (tenant config, user config, username, homedir).
+MOUNT_PLAN_CACHE_SIZE = int(os.environ.get('MOUNT_PLAN_CACHE_SIZE', 5000))
+mount_plans = OrderedDict()
+
+
+async def hook(spawner):
     spawner.start_timeout = 60 * 5
     spawner.log.info('👻 tenant configs 👻 {}'.format(spawner.configs))
     spawner.log.info('👽 user configs 👽 {}'.format(spawner.user_configs))
     spawner.log.info('😱 user options (from form) 😱 {}'.format(spawner.user_options))
 
-    get_agave_access_data(spawner)
+    if TOKEN_DELIVERY_MODE == 'entrypoint':
+        token_refresher.set_active(spawner.user.name, True)
+    spawner.access_token = spawner.refresh_token = spawner.url = None
+    await get_agave_tokens(spawner)
     spawner.log.info(
         'access token: {}, refresh token: {}, url: {}'.format(spawner.access_token, spawner.refresh_token, spawner.url))
-    get_tas_data(spawner)
+    # the TAS, extended profile and DesignSafe lookups do not depend on each other, so they all run
+    # at once; everything below only needs their results.
+    _, projects = await asyncio.gather(get_tas_data(spawner), fetch_projects(spawner))
 
-    spawner.uid = int(spawner.configs.get('uid', spawner.tas_uid))
-    spawner.gid = int(spawner.configs.get('gid', spawner.tas_gid))
+    configs = spawner.configs
+    spawner.uid = configs.uid if configs.uid is not None else int(spawner.tas_uid)
+    spawner.gid = configs.gid if configs.gid is not None else int(spawner.tas_gid)
 
-    spawner.extra_pod_config = spawner.configs.get('extra_pod_config', {})
-    spawner.extra_container_config = spawner.configs.get('extra_container_config', {})
+    # the compiled configs are shared between spawns, so the spawner gets its own copies to merge into.
+    spawner.extra_pod_config = copy.deepcopy(configs.extra_pod_config)
+    spawner.extra_container_config = copy.deepcopy(configs.extra_container_config)
 
-    if len(spawner.configs.get(
-            'images')) == 1 and not spawner.hpc_available:  # only 1 image option, so we skipped the form
-        spawner.image = spawner.configs.get('images')[0]['name']
+    catalog = spawner.image_catalog
+    if len(catalog.images) == 1 and not catalog.hpc_available:  # only 1 image option, so we skipped the form
+        spawner.image = catalog.images[0].name
     else:
         # verify form data
-        image_options = spawner.configs.get('images')
-        for item in spawner.user_configs:
-            for image in item['value']['images']:
-                image_options.append(image)
-
-        image = ast.literal_eval(spawner.user_options['image'][0])
         try:
-            spawner.log.info(
-                'Checking user options: image-{} hpc-{} against metadata: {}'.format(
-                    image, spawner.user_options.get('hpc'), image_options))
-            allowed_options = next(
-                option for option in image_options if option['name'] == image['name'] and option["display_name"] == image["display_name"]
-            )
-            if spawner.user_options.get('hpc'):
-                if not eval(allowed_options.get('hpc_available', 'False')):
-                    spawner.log.error(
-                        'hpc is not available for this image. {} -- {}'.format(spawner.user.name, allowed_options))
-                    raise web.HTTPError(403)
+            image = json.loads(spawner.user_options['image'][0])
+            spawner.log.info('Checking user options: image-{} hpc-{}'.format(image, spawner.user_options.get('hpc')))
+            allowed = catalog.allowed[(image['name'], image.get('display_name'))]
         except Exception as e:
             spawner.log.error('{} user options not allowed. selected options {}. allowed options {}. got an error:{}'
-                              .format(spawner.user.name, spawner.user_options, image_options, e))
+                              .format(spawner.user.name, spawner.user_options, list(catalog.allowed), e))
+            raise web.HTTPError(403)
+        if spawner.user_options.get('hpc') and not allowed.hpc_available:
+            spawner.log.error('hpc is not available for this image. {} -- {}'.format(spawner.user.name, allowed))
             raise web.HTTPError(403)
 
-        spawner.image = image['name']
-        if image.get('extra_pod_config'):
-            merge_configs(image['extra_pod_config'], spawner.extra_pod_config)
-        if image.get('extra_container_config'):
-            merge_configs(image['extra_container_config'], spawner.extra_pod_config)
-        spawner.notebook_dir = image.get('notebook_dir', '')
+        spawner.image = allowed.name
+        if allowed.extra_pod_config:
+            merge_configs(allowed.extra_pod_config, spawner.extra_pod_config)
+        if allowed.extra_container_config:
+            merge_configs(allowed.extra_container_config, spawner.extra_container_config)
+        spawner.notebook_dir = allowed.notebook_dir
 
     if not spawner.user_options.get('hpc'):
-        # find highest available limit between tenant/user/group configs
-        tenant_mem_limit = spawner.configs.get('mem_limit')
-        mem_limits = {tenant_mem_limit: humanfriendly.parse_size(tenant_mem_limit)}
-        cpu_limits = [spawner.configs.get('cpu_limit')]
-        for item in spawner.user_configs:
-            mem_limit = item['value'].get('mem_limit')
-            cpu_limit = item['value'].get('cpu_limit')
-            if mem_limit:
-                mem_limits.update({mem_limit: humanfriendly.parse_size(mem_limit)})
-            if cpu_limit:
-                cpu_limits.append(cpu_limit)
-        spawner.log.info('available limits -- mem: {} cpu:{}'.format(mem_limits, cpu_limits))
-        spawner.mem_limit = max(mem_limits, key=mem_limits.get)
-        spawner.cpu_limit = float(max(cpu_limits))
+        # highest available limit between tenant/user/group configs
+        profile = get_resource_profile(configs, spawner.user_configs_version, spawner.user_configs)
+        spawner.log.info('effective limits -- {}'.format(profile))
+        spawner.mem_limit = profile.mem_limit
+        spawner.cpu_limit = profile.cpu_limit
         # Set the guarantees really low because when None or 0,it sets a resource request for an amount equal to the limit
         spawner.mem_guarantee = '.001K'
         spawner.cpu_guarantee = float(0.001)
         spawner.environment = {
-            "MKL_NUM_THREADS": max(cpu_limits),
-            "NUMEXPR_NUM_THREADS": max(cpu_limits),
-            "OMP_NUM_THREADS": max(cpu_limits),
-            "OPENBLAS_NUM_THREADS": max(cpu_limits),
+            "MKL_NUM_THREADS": profile.num_threads,
+            "NUMEXPR_NUM_THREADS": profile.num_threads,
+            "OMP_NUM_THREADS": profile.num_threads,
+            "OPENBLAS_NUM_THREADS": profile.num_threads,
             "SCINCO_JUPYTERHUB_IMAGE": spawner.image
         }
     get_mounts(spawner)
-    get_projects(spawner)
+    add_project_mounts(spawner, projects)
+
+
+def stop_hook(spawner):
+    # stored tokens are only kept fresh while the user has a server using them.
+    token_refresher.set_active(spawner.user.name, False)
+
+
+def get_resource_profile(configs, user_version, user_configs):
+    """Return the memoized ResourceProfile for a tenant config and user config version."""
+    key = (configs.version, user_version)
+    profile = resource_profiles.get(key)
+    if profile is None:
+        profile = resource_profiles[key] = compile_resource_profile(configs, user_configs)
+        while len(resource_profiles) > RESOURCE_PROFILE_CACHE_SIZE:
+            resource_profiles.popitem(last=False)
+    else:
+        resource_profiles.move_to_end(key)
+    return profile
 
 
 def merge_configs(x, y):
@@ -104,43 +226,31 @@ def merge_configs(x, y):
             merged_pod_config[key].update(x[key])
 
 
-def get_oauth_client(base_url, access_token, refresh_token):
-    return Agave(api_server=base_url, token=access_token, refresh_token=refresh_token)
+class ImageCatalog(object):
+    """The images a user can choose from.
+
+    These are the tenant's images followed by the images of the user's config records, deduplicated
+    on (name, display_name) with the first occurrence kept, and sorted by name.
+    """
 
+    def __init__(self, tenant_images, user_configs):
+        index = {}
+        for image in tenant_images:
+            index.setdefault(image.key, image)
+        for item in user_configs:
+            for image in item.images:
+                index.setdefault(image.key, image)
+        # the compiled Images carry everything the pre-spawn hook needs to validate and apply a choice.
+        self.allowed = MappingProxyType(index)
+        self.images = sorted(index.values(), key=lambda image: image.name)
+        self.hpc_available = any(image.hpc_available for image in self.images)
 
-async def get_notebook_options(spawner):
-    spawner.configs = get_tenant_configs()
-    spawner.user_configs = get_user_configs(spawner.user.name)
-
-    image_options = spawner.configs.get('images')
-
-    for item in spawner.user_configs:
-        for image in item['value'].get('images'):
-            if image not in image_options:
-                image_options += [image]
-            if eval(image.get('hpc_available', 'False')):
-                spawner.hpc_available = True
-
-    if not hasattr(spawner, 'hpc_available'):  # only looped through user options -- check the tenant options for hpc
-        for image in spawner.configs.get('images'):
-            if eval(image.get('hpc_available', 'False')):
-                spawner.hpc_available = True
-                break
-            spawner.hpc_available = False
-
-    image_options = sorted(image_options, key=lambda d: d['name'])
-
-    if len(image_options) > 1 or spawner.hpc_available:
-        options = ''
-        for image in image_options:
-            options = options + " <option value='{}'> {} </option>".format(json.dumps(image),
-                                                                           image.get('display_name', image['name']))
-
-        if spawner.hpc_available:
-            hpc = '''<input type="checkbox" id="hpc" name="hpc" style="display: none">
+
+HPC_INPUT = '''<input type="checkbox" id="hpc" name="hpc" style="display: none">
                 <label for="hpc" id="hpc_label" style="display: none">Run on HPC</label>
                 '''
-            js = '''(function hpc(){
+
+HPC_JS = '''(function hpc(){
                 var select_element = document.getElementById('image');
                 var value = select_element.value || select_element.options[select_element.selectedIndex].value;
                 var value = JSON.parse(value);
@@ -159,8 +269,8 @@ async def get_notebook_options(spawner):
                     document.getElementById('hpc_label').style.display = 'none';
                 }
             })()'''
-        else:
-            js = '''(function hpc(){
+
+DESCRIPTION_JS = '''(function hpc(){
                             var select_element = document.getElementById('image');
                             var value = select_element.value || select_element.options[select_element.selectedIndex].value;
                             var value = JSON.parse(value);
@@ -171,11 +281,77 @@ async def get_notebook_options(spawner):
                             }
                         })()'''
 
-            hpc = ''
 
-        image_description = '<p id="image_description" style="display: inline-block"> </p>'
-        select_images = '<select id="image" name="image" size="10" onchange="{}"> {} </select>'.format(js, options)
-        return '{}{}{}'.format(select_images, image_description, hpc)
+def render_options_form(catalog, etag):
+    """Return the options form HTML for an image catalog, or None when there is nothing to choose."""
+    if len(catalog.images) <= 1 and not catalog.hpc_available:
+        return None
+    options = ''.join(" <option value='{}'> {} </option>".format(html.escape(image.document_json),
+                                                                 html.escape(image.display_name or image.name))
+                      for image in catalog.images)
+    js = HPC_JS if catalog.hpc_available else DESCRIPTION_JS
+    hpc = HPC_INPUT if catalog.hpc_available else ''
+    image_description = '<p id="image_description" style="display: inline-block"> </p>'
+    select_images = '<select id="image" name="image" size="10" data-etag="{}" onchange="{}"> {} </select>'.format(
+        etag, js, options)
+    return '{}{}{}'.format(select_images, image_description, hpc)
+
+
+def get_options_form(tenant_version, user_version, configs, user_configs):
+    """Return the memoized {'etag', 'catalog', 'html'} entry for a tenant config and user config version.
+
+    Users whose config records are identical share an entry.
+    """
+    key = (tenant_version, user_version)
+    form = options_forms.get(key)
+    if form is None:
+        etag = hashlib.sha1('{}:{}'.format(*key).encode('utf-8')).hexdigest()
+        catalog = ImageCatalog(configs.images, user_configs)
+        form = options_forms[key] = {'etag': etag, 'catalog': catalog, 'html': render_options_form(catalog, etag)}
+        while len(options_forms) > OPTIONS_FORM_CACHE_SIZE:
+            options_forms.popitem(last=False)
+    else:
+        options_forms.move_to_end(key)
+    return form
+
+
+async def get_notebook_options(spawner):
+    spawner.configs = get_tenant_configs()
+    spawner.user_configs = await get_user_configs(spawner.user.name)
+
+    spawner.user_configs_version = get_configs_version(spawner.user_configs)
+    form = get_options_form(spawner.configs.version, spawner.user_configs_version,
+                            spawner.configs, spawner.user_configs)
+    spawner.image_catalog = form['catalog']
+    spawner.hpc_available = form['catalog'].hpc_available
+    spawner.log.info("options form {} for {}".format(form['etag'], spawner.user.name))
+    return form['html']
+
+
+async def get_agave_tokens(spawner):
+    """Set the user's access token, refresh token and Agave URL on the spawner.
+
+    Tokens come from memory: the token refresh scheduler's copy when it is newer, otherwise the
+    user's auth_state. Only when auth_state is not enabled are the token files read from the token
+    store.
+    """
+    username = spawner.user.name
+    latest = token_refresher.latest(username)
+    auth_state = await spawner.user.get_auth_state()
+    if auth_state and auth_state.get('access_token'):
+        if not latest or latest['expires_at'] < auth_state.get('expires_at', 0):
+            # e.g. after a hub restart: schedule the refresh of the tokens saved in auth_state.
+            token_refresher.track(username, auth_state['access_token'], auth_state['refresh_token'],
+                                  auth_state.get('expires_at', 0))
+            latest = token_refresher.latest(username)
+        spawner.url = auth_state.get('api_server') or spawner.configs.agave_base_url
+    elif latest:
+        spawner.url = spawner.configs.agave_base_url
+    else:
+        await IOLoop.current().run_in_executor(None, get_agave_access_data, spawner)
+        return
+    spawner.access_token = latest['access_token']
+    spawner.refresh_token = latest['refresh_token']
 
 
 def get_agave_access_data(spawner):
@@ -187,16 +363,12 @@ def get_agave_access_data(spawner):
     # k8 names must consist of lower case alphanumeric characters, '-' or '.',
     # and must start and end with an alphanumeric character
     # do all tenant names follow that? usernames?
-    token_file = os.path.join(get_user_token_dir(spawner.user.name), '.agpy')
-    spawner.log.info("spawner looking for token file: {} for user: {}".format(token_file, spawner.user.name))
-    if not os.path.exists(token_file):
-        spawner.log.warning("spawner did not find a token file at {}".format(token_file))
-        return None
-    try:
-        data = json.load(open(token_file))
-    except ValueError:
-        spawner.log.warning('could not ready json from token file')
+    spawner.log.info("spawner looking for token files of user: {}".format(spawner.user.name))
+    files = get_token_store().get(spawner.user.name)
+    if not files or '.agpy' not in files:
+        spawner.log.warning("spawner did not find a .agpy token file for {}".format(spawner.user.name))
         return None
+    data = files['.agpy']
 
     try:
         spawner.access_token = data[0]['token']
@@ -211,7 +383,7 @@ def get_agave_access_data(spawner):
         return None
 
 
-def get_tas_data(spawner):
+async def get_tas_data(spawner):
     """Get the TACC uid, gid and homedir for this user from the TAS API."""
     if not TAS_ROLE_ACCT:
         spawner.log.error("No TAS_ROLE_ACCT configured. Aborting.")
@@ -219,75 +391,193 @@ def get_tas_data(spawner):
     if not TAS_ROLE_PASS:
         spawner.log.error("No TAS_ROLE_PASS configured. Aborting.")
         return
+    # the "extended profile" record in agave metadata might have the gid to use for this user. it is
+    # only consulted when TAS has no gid: with a cached identity that is known up front, otherwise it
+    # is requested alongside TAS so the two calls overlap. a tenant-wide gid wins over both, in which
+    # case there is no point asking.
+    found, tas_data = get_cached_tas_user(spawner)
+    profile_gid = None
+    if not found:
+        tas_data, profile_gid = await asyncio.gather(fetch_tas_user(spawner), fetch_profile_gid(spawner))
+    if tas_data is None:
+        return
+    spawner.tas_gid = None
+    try:
+        spawner.tas_uid = tas_data['uid']
+        spawner.tas_gid = tas_data['gid']
+        spawner.tas_homedir = tas_data['homeDirectory']
+    except Exception as e:
+        spawner.log.error("Did not get attributes from TAS API. data: {} "
+                          "Exception: {}. TAS_ROLE_ACCT: {}".format(tas_data, e, TAS_ROLE_ACCT))
+        return
+
+    if not spawner.tas_gid:
+        if found:
+            profile_gid = await fetch_profile_gid(spawner)
+        spawner.tas_gid = profile_gid
+    # if the instance has a configured TAS_GID to use we will use that; otherwise,
+    # we fall back on using the user's uid as the gid, which is (almost) always safe)
+    if not spawner.tas_gid:
+        spawner.tas_gid = spawner.configs.gid if spawner.configs.gid is not None else spawner.tas_uid
+    spawner.log.info("Setting the following TAS data: uid:{} gid:{} homedir:{}".format(spawner.tas_uid,
+                                                                                       spawner.tas_gid,
+                                                                                       spawner.tas_homedir))
+
+
+def get_cached_tas_user(spawner):
+    """Return (found, record) for this user's live entry in the TAS identity cache."""
+    try:
+        found, record = tas_identity_cache.get(spawner.user.name)
+    except sqlite3.Error as e:
+        spawner.log.warning("Could not read the TAS identity cache at {}. Exception: {}".format(TAS_CACHE_DB, e))
+        return False, None
+    if found:
+        spawner.log.info("Using cached TAS data for {}: {}".format(spawner.user.name, record))
+    return found, record
+
+
+async def fetch_tas_user(spawner):
+    """Ask TAS for the identity (uid, gid, homeDirectory) of this user and cache it. Returns None if
+    there is none.
+
+    If TAS fails, the last known record is used even if it has expired.
+    """
+    try:
+        record = await request_tas_user(spawner)
+    except Exception:
+        try:
+            record = tas_identity_cache.get_stale(spawner.user.name)
+        except sqlite3.Error:
+            record = None
+        if record:
+            spawner.log.warning("Using expired TAS data for {}: {}".format(spawner.user.name, record))
+        return record
+    try:
+        tas_identity_cache.put(spawner.user.name, record)
+    except sqlite3.Error as e:
+        spawner.log.warning("Could not write the TAS identity cache at {}. Exception: {}".format(TAS_CACHE_DB, e))
+    return record
+
+
+async def request_tas_user(spawner):
+    """Query TAS for the identity of this user. Returns None for an unknown user and raises if TAS could
+    not be queried."""
     url = '{}/users/username/{}'.format(TAS_URL_BASE, spawner.user.name)
     headers = {'Content-type': 'application/json',
                'Accept': 'application/json'
                }
+    req = HTTPRequest(url,
+                      headers=headers,
+                      auth_username=TAS_ROLE_ACCT,
+                      auth_password=TAS_ROLE_PASS,
+                      connect_timeout=AGAVE_CONNECT_TIMEOUT,
+                      request_timeout=AGAVE_REQUEST_TIMEOUT,
+                      )
     try:
-        rsp = requests.get(url,
-                           headers=headers,
-                           auth=requests.auth.HTTPBasicAuth(TAS_ROLE_ACCT, TAS_ROLE_PASS))
+        rsp = await get_http_client().fetch(req)
+    except HTTPClientError as e:
+        if e.code == 404:
+            spawner.log.warning("TAS does not know user {}. url: {}".format(spawner.user.name, url))
+            return None
+        spawner.log.error("Got an exception from TAS API. "
+                          "Exception: {}. url: {}. TAS_ROLE_ACCT: {}".format(e, url, TAS_ROLE_ACCT))
+        raise
     except Exception as e:
         spawner.log.error("Got an exception from TAS API. "
                           "Exception: {}. url: {}. TAS_ROLE_ACCT: {}".format(e, url, TAS_ROLE_ACCT))
-        return
+        raise
     try:
-        data = rsp.json()
+        data = json.loads(rsp.body.decode('utf8', 'replace'))
     except Exception as e:
         spawner.log.error("Did not get JSON from TAS API. rsp: {}"
                           "Exception: {}. url: {}. TAS_ROLE_ACCT: {}".format(rsp, e, url, TAS_ROLE_ACCT))
-        return
-    spawner.tas_gid = None
+        raise
+    return get_tas_identity(data.get('result'))
+
+
+async def fetch_profile_gid(spawner):
+    """Return the posix_gid of the user's extended profile record in agave metadata, if there is one."""
+    if spawner.configs.gid is not None or not (spawner.access_token and spawner.url):
+        return None
+    ag = AgaveMetadataClient(spawner.url, spawner.access_token)
+    q = {'name': 'profile.{}.{}'.format(TENANT, spawner.user.name)}
+    spawner.log.info("using query: {}".format(q))
     try:
-        spawner.tas_uid = data['result']['uid']
-        spawner.tas_gid = data['result']['gid']
-        spawner.tas_homedir = data['result']['homeDirectory']
+        rsp = await ag.list_metadata(q)
     except Exception as e:
-        spawner.log.error("Did not get attributes from TAS API. rsp: {}"
-                          "Exception: {}. url: {}. TAS_ROLE_ACCT: {}".format(rsp, e, url, TAS_ROLE_ACCT))
-        return
+        spawner.log.error("Got an exception trying to retrieve the extended profile. Exception: {}".format(e))
+        return None
+    try:
+        return rsp[0]['value']['posix_gid']
+    except IndexError:
+        return None
+    except Exception as e:
+        spawner.log.error(
+            "Got an exception trying to retrieve the gid from the extended profile. Exception: {}".format(e))
+        return None
 
-    # first look for an "extended profile" record in agave metadata. such a record might have the
-    # gid to use for this user.
-    if spawner.access_token and spawner.refresh_token and spawner.url and not spawner.tas_gid:
-        ag = get_oauth_client(spawner.url, spawner.access_token, spawner.refresh_token)
-        meta_name = 'profile.{}.{}'.format(TENANT, spawner.user.name)
-        q = "{'name': '" + meta_name + "'}"
-        spawner.log.info("using query: {}".format(q))
-        try:
-            rsp = ag.meta.listMetadata(q=q)
-        except Exception as e:
-            spawner.log.error("Got an exception trying to retrieve the extended profile. Exception: {}".format(e))
-        try:
-            spawner.tas_gid = rsp[0].value['posix_gid']
-        except IndexError:
-            spawner.tas_gid = None
-        except Exception as e:
-            spawner.log.error(
-                "Got an exception trying to retrieve the gid from the extended profile. Exception: {}".format(e))
-    # if the instance has a configured TAS_GID to use we will use that; otherwise,
-    # we fall back on using the user's uid as the gid, which is (almost) always safe)
-    if not spawner.tas_gid:
-        spawner.tas_gid = spawner.configs.get('gid', spawner.tas_uid)
-    spawner.log.info("Setting the following TAS data: uid:{} gid:{} homedir:{}".format(spawner.tas_uid,
-                                                                                       spawner.tas_gid,
-                                                                                       spawner.tas_homedir))
 
+def add_token_mounts(spawner):
+    """Deliver the user's token files (.agpy and ~/.agave/current) as set by TOKEN_DELIVERY_MODE."""
+    cmd = list(spawner.cmd)
+    if cmd[:len(TOKEN_ENTRYPOINT)] == TOKEN_ENTRYPOINT:
+        # the spawner object is reused between spawns; unwrap the command of an earlier one.
+        cmd = cmd[len(TOKEN_ENTRYPOINT):]
+    if TOKEN_DELIVERY_MODE == 'entrypoint':
+        add_entrypoint_token_mounts(spawner)
+        cmd = TOKEN_ENTRYPOINT + cmd
+    else:
+        add_init_container_token_mounts(spawner)
+    spawner.cmd = cmd
+    spawner.extra_annotations = dict(spawner.extra_annotations,
+                                     **{'jupyterhub.tacc.utexas.edu/token-delivery': TOKEN_DELIVERY_MODE})
 
-def get_user_token_dir(username):
-    return os.path.join(
-        '/agave/jupyter/tokens',
-        INSTANCE,
-        TENANT,
-        username)
 
+def add_entrypoint_token_mounts(spawner):
+    """Token files without an init container.
 
-def get_mounts(spawner):
+    The ConfigMap is mounted read-only, and TOKEN_ENTRYPOINT, a shell wrapper around the notebook
+    command, copies `current` and `.agpy` into a memory-backed emptyDir at ~/.agave, so agavepy can
+    rewrite both when it refreshes. agavepy finds them through AGAVE_CACHE_DIR and a ~/.agpy symlink;
+    there is no /etc/.agpy in this mode, since a file there could only be a read-only subPath mount.
+    The ConfigMap is mounted as a directory, which the kubelet keeps up to date, and the wrapper
+    copies each file again in the background whenever the hub has written a new one.
+    """
+    safe_username = safe_string(spawner.user.name).lower()
+    safe_tenant = safe_string(TENANT).lower()
+    safe_instance = safe_string(INSTANCE).lower()
+    current_safe_name = '{}-{}-{}-jhub-current'.format(safe_username, safe_tenant, safe_instance)
+    token_configmap_name = get_token_configmap_name(spawner.user.name)
+
+    spawner.init_containers = []
+    spawner.volumes = [
+        {'name': '{}-configmap'.format(token_configmap_name),
+         'configMap': {'name': token_configmap_name, 'defaultMode': 0o0644}
+         },
+        {'name': current_safe_name,
+         'emptyDir': {'medium': 'Memory'},
+         },
+    ]
+    spawner.volume_mounts = [
+        {'mountPath': '/agave_data',
+         'name': '{}-configmap'.format(token_configmap_name),
+         'readOnly': True,
+         },
+        {'mountPath': '/home/jupyter/.agave',
+         'name': current_safe_name,
+         },
+    ]
+    spawner.environment = dict(spawner.environment, AGAVE_CACHE_DIR='/home/jupyter/.agave')
+
+
+def add_init_container_token_mounts(spawner):
+    """Copy the token files from the ConfigMap into writable emptyDirs with a busybox init container."""
     safe_username = safe_string(spawner.user.name).lower()
     safe_tenant = safe_string(TENANT).lower()
     safe_instance = safe_string(INSTANCE).lower()
     agpy_safe_name = '{}-{}-{}-jhub-agpy'.format(safe_username, safe_tenant, safe_instance)
     current_safe_name = '{}-{}-{}-jhub-current'.format(safe_username, safe_tenant, safe_instance)
+    token_configmap_name = get_token_configmap_name(spawner.user.name)
 
     spawner.init_containers = [{
         "name": "rw-configmap-workaround",
@@ -297,12 +587,12 @@ def get_mounts(spawner):
         "volumeMounts": [
             {
                 'mountPath': '/agave_data/.agpy',
-                'name': '{}-configmap'.format(agpy_safe_name),
+                'name': '{}-configmap'.format(token_configmap_name),
                 'subPath': '.agpy',
             },
             {
                 'mountPath': '/agave_data/current',
-                'name': '{}-configmap'.format(current_safe_name),
+                'name': '{}-configmap'.format(token_configmap_name),
                 'subPath': 'current',
             },
             {
@@ -320,11 +610,8 @@ def get_mounts(spawner):
     }]
 
     spawner.volumes = [
-        {'name': '{}-configmap'.format(agpy_safe_name),
-         'configMap': {'name': agpy_safe_name, 'defaultMode': 0o0777}
-         },
-        {'name': '{}-configmap'.format(current_safe_name),
-         'configMap': {'name': current_safe_name, 'defaultMode': 0o0777}
+        {'name': '{}-configmap'.format(token_configmap_name),
+         'configMap': {'name': token_configmap_name, 'defaultMode': 0o0777}
          },
         {'name': agpy_safe_name,
          'emptyDir': {},
@@ -343,97 +630,150 @@ def get_mounts(spawner):
          'subPath': 'current',
          },
     ]
-    volume_mounts = spawner.configs.get('volume_mounts')
 
-    for item in spawner.user_configs:
-        if item['value'].get('volume_mounts'):
-            volume_mounts += [x for x in item['value']['volume_mounts'] if x not in volume_mounts]
 
+def get_mounts(spawner):
+    add_token_mounts(spawner)
+    plan = get_mount_plan(spawner.configs, spawner.user_configs_version, spawner.user_configs,
+                          spawner.user.name, getattr(spawner, 'tas_homedir', None))
+    spawner.volumes.extend(plan['volumes'])
+    spawner.volume_mounts.extend(plan['volume_mounts'])
+    spawner.log.info('volumes: {}'.format(spawner.volumes))
+    spawner.log.info('volume_mounts: {}'.format(spawner.volume_mounts))
+
+
+def get_volume_name(item, path):
+    """Deterministic volume name for a mount: the last mountPath segment plus a digest of the source.
+
+    Volume names must consist of lower case alphanumeric characters or '-', must start and end with
+    an alphanumeric character and be at most 63 characters long.
+    """
+    slug = re.sub(r'[^a-z0-9-]+', '', item.mount_path.split('/')[-1].lower()).strip('-')[:40] or 'vol'
+    digest = hashlib.sha1('{}:{}:{}'.format(item.type, item.server, path).encode('utf-8')).hexdigest()[:10]
+    return '{}-{}'.format(slug, digest)
+
+
+def build_mount_plan(configs, user_configs, username, tas_homedir):
+    """Resolve the tenant, group and user volume_mounts into the pod's `volumes` and `volume_mounts`.
+
+    Mounts are indexed by mountPath: the first one wins (tenant, then the user config records in
+    order) and a later mount on the same path is logged and left out. Volumes are indexed by name,
+    and since the name includes a digest of the source, two mountPaths of the same share use one volume.
+    """
     template_vars = {
-        'username': spawner.user.name,
+        'username': username,
         'tenant_id': TENANT,  # TODO do we need this?
     }
+    if tas_homedir is not None:
+        template_vars['tas_homedir'] = tas_homedir
+
+    volumes = OrderedDict()
+    volume_mounts = OrderedDict()
+    for item in configs.volume_mounts + tuple(m for c in user_configs for m in c.volume_mounts):
+        if item.mount_path in volume_mounts:
+            if volume_mounts[item.mount_path]['source'] != item:
+                app_log.warning('Ignoring volume mount {} for {}: mountPath is already used by {}'.format(
+                    item, username, volume_mounts[item.mount_path]['source']))
+            continue
+        path = item.path.format(**template_vars)
+        vol_name = get_volume_name(item, path)
+        vol = {
+            'path': path,
+            'readOnly': item.read_only
+        }
+        if item.type == 'nfs':
+            vol['server'] = item.server
+        volume = {'name': vol_name, item.type: vol}
+        if vol_name in volumes and volumes[vol_name] != volume:
+            # same source mounted read-only in one place and read-write in another.
+            vol_name = '{}-{}'.format(vol_name[:52], 'ro' if item.read_only else 'rw')
+            volume['name'] = vol_name
+        volumes.setdefault(vol_name, volume)
+        volume_mounts[item.mount_path] = {'source': item, 'mount': {'mountPath': item.mount_path, 'name': vol_name}}
+    return {
+        'volumes': tuple(volumes.values()),
+        'volume_mounts': tuple(m['mount'] for m in volume_mounts.values()),
+    }
 
-    if hasattr(spawner, 'tas_homedir'):
-        template_vars['tas_homedir'] = spawner.tas_homedir
-
-    if len(volume_mounts):
-        for item in volume_mounts:
-            path = item['path'].format(**template_vars)
-
-            # volume names must consist of lower case alphanumeric characters or '-',
-            # and must start and end with an alphanumeric character (e.g. 'my-name',  or '123-abc',
-            # regex used for validation is '[a-z0-9]([-a-z0-9]*[a-z0-9])?')
-            if item["mountPath"][-1] == '/':
-                item["mountPath"] = item["mountPath"][:-1]
-            vol_name = re.sub(r'([^a-z0-9-\s]+?)', '', item['mountPath'].split('/')[-1].lower())
 
-            vol = {
-                'path': path,
-                'readOnly': eval(item['readOnly'])
-            }
-            if item['type'] == 'nfs':
-                vol['server'] = item['server']
+def get_mount_plan(configs, user_version, user_configs, username, tas_homedir):
+    """Return the memoized mount plan for a tenant config and user config version, username and homedir.
 
-            spawner.volumes.append({
-                'name': vol_name,
-                item['type']: vol
-            })
+    The plan's dicts are shared between spawns and must not be changed.
+    """
+    key = (configs.version, user_version, username, tas_homedir)
+    plan = mount_plans.get(key)
+    if plan is None:
+        plan = mount_plans[key] = build_mount_plan(configs, user_configs, username, tas_homedir)
+        while len(mount_plans) > MOUNT_PLAN_CACHE_SIZE:
+            mount_plans.popitem(last=False)
+    else:
+        mount_plans.move_to_end(key)
+    return plan
 
-            spawner.volume_mounts.append({
-                'mountPath': item['mountPath'],
-                'name': vol_name
-            })
-        spawner.log.info('volumes: {}'.format(spawner.volumes))
-        spawner.log.info('volume_mounts: {}'.format(spawner.volume_mounts))
 
+async def fetch_projects(spawner):
+    """Return the DesignSafe projects of this user, or None if projects are not configured or unavailable.
 
-def get_projects(spawner):
-    spawner.host_projects_root_dir = spawner.configs.get('host_projects_root_dir')
-    spawner.container_projects_root_dir = spawner.configs.get('container_projects_root_dir')
-    spawner.network_storage = spawner.configs.get('network_storage')
-    spawner.jupyterh_bearer_token = spawner.configs.get('jupyterh_bearer_token')
+    The list is served from memory for PROJECTS_CACHE_TTL seconds. After that it is revalidated with
+    a conditional request, and the cached copy is kept on a 304 or when DesignSafe cannot be reached.
+    """
+    spawner.host_projects_root_dir = spawner.configs.host_projects_root_dir
+    spawner.container_projects_root_dir = spawner.configs.container_projects_root_dir
+    spawner.network_storage = spawner.configs.network_storage
+    spawner.jupyterh_bearer_token = spawner.configs.jupyterh_bearer_token
     if not spawner.host_projects_root_dir or not spawner.container_projects_root_dir:
         spawner.log.info("No host_projects_root_dir or container_projects_root_dir. configs:{}".format(spawner.configs))
         return None
     if not spawner.access_token or not spawner.url:
         spawner.log.info("no access_token or url")
         return None
+    cached = projects_cache.get(spawner.user.name)
+    if cached and time.time() - cached['fetched_at'] < PROJECTS_CACHE_TTL:
+        projects_cache.move_to_end(spawner.user.name)
+        spawner.log.info("Using {} cached projects for {}".format(len(cached['projects']), spawner.user.name))
+        return cached['projects']
+    stale_projects = cached['projects'] if cached else None
+
     url = f"https://www.designsafe-ci.org/api/projects/?user={spawner.user.name}"
-    ds_assert_jwt = ""
-    # generate x-jwt-assertion-designsafe JWT
     try:
-        headers = {
-            "Authorization": f"Bearer {spawner.jupyterh_bearer_token}"
-        }
-
-        rsp = requests.get("https://agave.designsafe-ci.org/headers", headers=headers)
-        spawner.log.info(rsp)
-        data = rsp.json()
-        spawner.log.info(data)
-        ds_assert_jwt = data['headers']['X-Jwt-Assertion-Designsafe']
+        ds_assert_jwt = await get_designsafe_assertion(spawner.jupyterh_bearer_token)
         spawner.log.info(ds_assert_jwt)
     except Exception as e:
         spawner.log.warn(f"Unable to generate designsafe assertion jwt; error: {e}")
-        return None
-    
+        return stale_projects
+
     # use x-jwt-assertion-designsafe to call projects api
+    headers = {
+        "X-Jwt-Assertion-Designsafe": ds_assert_jwt
+    }
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
     try:
-        headers = {
-            "X-Jwt-Assertion-Designsafe": ds_assert_jwt
-        }
-        
-        rsp = requests.get(url, headers=headers)
+        rsp = await get_http_client().fetch(HTTPRequest(url,
+                                                        headers=headers,
+                                                        connect_timeout=AGAVE_CONNECT_TIMEOUT,
+                                                        request_timeout=AGAVE_REQUEST_TIMEOUT),
+                                            raise_error=False)
     except Exception as e:
         spawner.log.warn(f"Got exception calling /projects for user: {spawner.user.name}; error: {e}")
-        return None
+        return stale_projects
+    if rsp.code == 304 and cached:
+        spawner.log.info("projects for {} not modified".format(spawner.user.name))
+        cached['fetched_at'] = time.time()
+        return cached['projects']
+    if rsp.error:
+        spawner.log.warn(f"Got an error calling /projects for user: {spawner.user.name}; error: {rsp.error}")
+        return stale_projects
     try:
-        data = rsp.json()
+        data = json.loads(rsp.body.decode('utf8', 'replace'))
     except ValueError as e:
         spawner.log.warn("Did not get JSON from /projects. Exception: {}".format(e))
         spawner.log.warn("Full response from service: {}".format(rsp))
         spawner.log.warn("url used: {}".format(url))
-        return None
+        return stale_projects
     projects = data.get('projects')
     spawner.log.info("service returned projects: {}".format(projects))
     try:
@@ -441,7 +781,64 @@ def get_projects(spawner):
     except TypeError:
         spawner.log.error("Projects data has no length.")
         spawner.log.info("response: {}, data: {}".format(rsp, data))
+        return stale_projects
+    projects_cache[spawner.user.name] = {
+        'projects': projects,
+        'etag': rsp.headers.get('Etag'),
+        'last_modified': rsp.headers.get('Last-Modified'),
+        'fetched_at': time.time(),
+    }
+    projects_cache.move_to_end(spawner.user.name)
+    while len(projects_cache) > PROJECTS_CACHE_SIZE:
+        projects_cache.popitem(last=False)
+    return projects
+
+
+async def get_designsafe_assertion(bearer_token):
+    """Return an X-Jwt-Assertion-Designsafe JWT for `bearer_token`.
+
+    The assertion is reused until DESIGNSAFE_JWT_EXPIRY_MARGIN seconds before its `exp` claim.
+    """
+    cached = designsafe_assertions.get(bearer_token)
+    if cached and cached['expires_at'] - DESIGNSAFE_JWT_EXPIRY_MARGIN > time.time():
+        return cached['jwt']
+    headers = {
+        "Authorization": f"Bearer {bearer_token}"
+    }
+    rsp = await get_http_client().fetch(HTTPRequest("https://agave.designsafe-ci.org/headers",
+                                                    headers=headers,
+                                                    connect_timeout=AGAVE_CONNECT_TIMEOUT,
+                                                    request_timeout=AGAVE_REQUEST_TIMEOUT))
+    data = json.loads(rsp.body.decode('utf8', 'replace'))
+    jwt = data['headers']['X-Jwt-Assertion-Designsafe']
+    expires_at = get_jwt_expiry(jwt)
+    if expires_at:
+        designsafe_assertions[bearer_token] = {'jwt': jwt, 'expires_at': expires_at}
+    return jwt
+
+
+def get_jwt_expiry(jwt):
+    """Return the `exp` claim of a JWT without verifying it, or None if it has none."""
+    try:
+        payload = jwt.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
         return None
+
+
+def add_project_mounts(spawner, projects):
+    """Mount the user's DesignSafe projects below container_projects_root_dir, as set by the
+    tenant's projects_mount_mode.
+
+    `volume` adds one NFS volume per project. `subpath` and `symlinks` mount host_projects_root_dir
+    once, so kubelet makes one NFS mount per pod however many projects the user has.
+    """
+    # the spawner object is reused between spawns; drop the symlinks hook of an earlier one.
+    spawner.lifecycle_hooks = {}
+    if not projects:
+        return
+    mounts = []
     for p in projects:
         uuid = p.get('uuid')
         if not uuid:
@@ -451,19 +848,50 @@ def get_projects(spawner):
         if not project_id:
             spawner.log.warn("Did not get a projectId for a project: {}".format(p))
             continue
+        mounts.append((uuid, '{}/{}'.format(spawner.container_projects_root_dir, project_id)))
 
+    mode = spawner.configs.projects_mount_mode
+    if mode == 'volume':
+        for uuid, mount_path in mounts:
+            spawner.volumes.append({
+                'name': 'project-{}'.format(safe_string(uuid).lower()),
+                'nfs': {
+                    'server': spawner.network_storage,
+                    'path': '{}/{}'.format(spawner.host_projects_root_dir, uuid),
+                    'readOnly': False
+                }
+            })
+
+            spawner.volume_mounts.append({
+                'mountPath': mount_path,
+                'name': 'project-{}'.format(safe_string(uuid).lower()),
+            })
+    elif mounts:
         spawner.volumes.append({
-            'name': 'project-{}'.format(safe_string(uuid).lower()),
+            'name': PROJECTS_VOLUME_NAME,
             'nfs': {
                 'server': spawner.network_storage,
-                'path': '{}/{}'.format(spawner.host_projects_root_dir, uuid),
+                'path': spawner.host_projects_root_dir,
                 'readOnly': False
             }
         })
-
-        spawner.volume_mounts.append({
-            'mountPath': '{}/{}'.format(spawner.container_projects_root_dir, project_id),
-            'name': 'project-{}'.format(safe_string(uuid).lower()),
-        })
+        if mode == 'subpath':
+            for uuid, mount_path in mounts:
+                spawner.volume_mounts.append({
+                    'mountPath': mount_path,
+                    'name': PROJECTS_VOLUME_NAME,
+                    'subPath': uuid,
+                })
+        else:
+            spawner.volume_mounts.append({
+                'mountPath': PROJECTS_SYMLINK_ROOT,
+                'name': PROJECTS_VOLUME_NAME,
+            })
+            links = ' && '.join('ln -sfn {} {}'.format(
+                shlex.quote('{}/{}'.format(PROJECTS_SYMLINK_ROOT, uuid)), shlex.quote(mount_path))
+                for uuid, mount_path in mounts)
+            spawner.lifecycle_hooks = {'postStart': {'exec': {'command': [
+                '/bin/sh', '-c', 'mkdir -p {} && {}'.format(
+                    shlex.quote(spawner.container_projects_root_dir), links)]}}}
     spawner.log.info(spawner.volumes)
     spawner.log.info(spawner.volume_mounts)
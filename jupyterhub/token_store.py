@@ -0,0 +1,208 @@
+"""
+Storage for the token files of each user: `.agpy` (agavepy) and `current` (Agave CLI).
+
+TOKEN_STORE picks the backend:
+  directory  the original layout, one directory per user with one JSON file per token file:
+             <TOKEN_STORE_DIR>/<instance>/<tenant>/<username>/<name>
+  sqlite     SQLite databases in WAL mode, TOKEN_STORE_SHARDS of them, with each username always
+             going to the same shard. Each write is a single transaction. WAL needs a local
+             filesystem, so TOKEN_STORE_DB must not point to the shared NFS mount.
+
+Both backends read and write a user's token files as a dict {name: data}. `get_many` and
+`put_many` handle many users at once; the sqlite backend does each shard in one query or
+transaction.
+
+Copy the existing token files into the sqlite backend with:
+
+    python -m jupyterhub.token_store export [--batch-size 500]
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from jupyterhub.common import TENANT, INSTANCE
+
+# which backend stores the token files ('directory' or 'sqlite') and where.
+TOKEN_STORE = os.environ.get('TOKEN_STORE', 'directory')
+TOKEN_STORE_DIR = os.environ.get('TOKEN_STORE_DIR', '/agave/jupyter/tokens')
+TOKEN_STORE_DB = os.environ.get('TOKEN_STORE_DB', '/srv/jupyterhub/tokens-{shard}.sqlite')
+TOKEN_STORE_SHARDS = int(os.environ.get('TOKEN_STORE_SHARDS', 8))
+
+# sqlite allows at most 999 parameters per statement.
+SQLITE_BATCH_SIZE = 500
+
+
+class DirectoryTokenStore(object):
+    """Token files kept as JSON files in a directory per user."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_user_dir(self, username):
+        return os.path.join(self.root, INSTANCE, TENANT, username)
+
+    def get(self, username):
+        """Return {name: data} for the token files of `username`, or None if there are none."""
+        user_dir = self.get_user_dir(username)
+        try:
+            names = os.listdir(user_dir)
+        except OSError:
+            return None
+        files = {}
+        for name in names:
+            try:
+                with open(os.path.join(user_dir, name)) as f:
+                    files[name] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return files or None
+
+    def get_many(self, usernames):
+        return {username: self.get(username) for username in usernames}
+
+    def put(self, username, files):
+        user_dir = self.get_user_dir(username)
+        os.makedirs(user_dir, exist_ok=True)
+        for name, data in files.items():
+            with open(os.path.join(user_dir, name), 'w') as f:
+                json.dump(data, f)
+
+    def put_many(self, items):
+        for username, files in items.items():
+            self.put(username, files)
+
+    def usernames(self):
+        try:
+            return sorted(os.listdir(os.path.join(self.root, INSTANCE, TENANT)))
+        except OSError:
+            return []
+
+
+class SqliteTokenStore(object):
+    """Token files kept in sharded SQLite databases in WAL mode, one row per (username, file name).
+
+    Connections are shared between threads, so every access goes through the shard's lock.
+    """
+
+    def __init__(self, path_template, shards):
+        self.path_template = path_template
+        self.shards = shards
+        self._dbs = {}
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def shard(self, username):
+        return zlib.crc32(username.encode('utf-8')) % self.shards
+
+    def db(self, shard):
+        db = self._dbs.get(shard)
+        if db is None:
+            db = sqlite3.connect(self.path_template.format(shard=shard), isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS token_files ('
+                       'instance TEXT, tenant TEXT, username TEXT, name TEXT, data TEXT, updated_at REAL, '
+                       'PRIMARY KEY (instance, tenant, username, name))')
+            self._dbs[shard] = db
+        return db
+
+    def _by_shard(self, usernames):
+        shards = {}
+        for username in usernames:
+            shards.setdefault(self.shard(username), []).append(username)
+        return shards
+
+    def get(self, username):
+        """Return {name: data} for the token files of `username`, or None if there are none."""
+        return self.get_many([username])[username]
+
+    def get_many(self, usernames):
+        result = {username: None for username in usernames}
+        rows = []
+        for shard, names in self._by_shard(usernames).items():
+            for i in range(0, len(names), SQLITE_BATCH_SIZE):
+                batch = names[i:i + SQLITE_BATCH_SIZE]
+                with self._locks[shard]:
+                    rows += self.db(shard).execute(
+                        'SELECT username, name, data FROM token_files WHERE instance = ? AND tenant = ? '
+                        'AND username IN ({})'.format(','.join('?' * len(batch))),
+                        [INSTANCE, TENANT] + batch).fetchall()
+        for username, name, data in rows:
+            if result[username] is None:
+                result[username] = {}
+            result[username][name] = json.loads(data)
+        return result
+
+    def put(self, username, files):
+        self.put_many({username: files})
+
+    def put_many(self, items):
+        now = time.time()
+        for shard, names in self._by_shard(items).items():
+            rows = [(INSTANCE, TENANT, username, name, json.dumps(data), now)
+                    for username in names for name, data in items[username].items()]
+            with self._locks[shard]:
+                db = self.db(shard)
+                db.execute('BEGIN')
+                try:
+                    db.executemany('INSERT OR REPLACE INTO token_files VALUES (?, ?, ?, ?, ?, ?)', rows)
+                except Exception:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+
+    def usernames(self):
+        usernames = set()
+        for shard in range(self.shards):
+            with self._locks[shard]:
+                rows = self.db(shard).execute('SELECT DISTINCT username FROM token_files '
+                                              'WHERE instance = ? AND tenant = ?', (INSTANCE, TENANT)).fetchall()
+            usernames.update(row[0] for row in rows)
+        return sorted(usernames)
+
+
+_token_store = None
+
+
+def get_token_store():
+    """The token store configured by TOKEN_STORE, shared by the authenticator and the spawner hooks."""
+    global _token_store
+    if _token_store is None:
+        if TOKEN_STORE == 'sqlite':
+            _token_store = SqliteTokenStore(TOKEN_STORE_DB, TOKEN_STORE_SHARDS)
+        elif TOKEN_STORE == 'directory':
+            _token_store = DirectoryTokenStore(TOKEN_STORE_DIR)
+        else:
+            raise ValueError("TOKEN_STORE must be directory or sqlite, got {!r}".format(TOKEN_STORE))
+    return _token_store
+
+
+def export(batch_size):
+    """Copy every user's token files from the directory layout into the sqlite store."""
+    source = DirectoryTokenStore(TOKEN_STORE_DIR)
+    target = SqliteTokenStore(TOKEN_STORE_DB, TOKEN_STORE_SHARDS)
+    usernames = source.usernames()
+    copied = 0
+    for i in range(0, len(usernames), batch_size):
+        batch = {username: files for username, files in source.get_many(usernames[i:i + batch_size]).items()
+                 if files}
+        target.put_many(batch)
+        copied += len(batch)
+        print('exported {} of {} users'.format(copied, len(usernames)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the token store.')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help='copy the token files of the directory layout into sqlite')
+    export_parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args.batch_size)
+    else:
+        parser.print_help()